@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compare how long it takes to download and parse a buildhub.json from S3
+the old way (download_fileobj() into a BytesIO) versus the new way
+(a single get_object() whose body is parsed directly).
+
+Example:
+
+    python bin/benchmark-s3-fetch.py \\
+        net-mozaws-prod-delivery-firefox \\
+        pub/firefox/releases/79.0/linux-x86_64/en-US/buildhub.json
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+import boto3
+from botocore import UNSIGNED
+from botocore.client import Config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buildhub.ingest.s3 import fetch_json  # noqa
+
+
+def download_fileobj(s3_client, bucket_name, key_name):
+    with io.BytesIO() as f:
+        s3_client.download_fileobj(bucket_name, key_name, f)
+        f.seek(0)
+        return json.load(f)
+
+
+def get_object(s3_client, bucket_name, key_name):
+    return fetch_json(s3_client, bucket_name, key_name)
+
+
+def run(bucket_name, key_name, iterations, region_name, signed):
+    config = None if signed else Config(signature_version=UNSIGNED)
+    s3_client = boto3.client("s3", region_name, config=config)
+    functions = (download_fileobj, get_object)
+    times = {function.__name__: [] for function in functions}
+    # Warm up the connection pool so the first call doesn't skew anything.
+    for function in functions:
+        function(s3_client, bucket_name, key_name)
+    for _ in range(iterations):
+        # Alternate so that network weather affects both equally.
+        for function in functions:
+            t0 = time.perf_counter()
+            function(s3_client, bucket_name, key_name)
+            t1 = time.perf_counter()
+            times[function.__name__].append(1000 * (t1 - t0))
+
+    for name, measurements in times.items():
+        print(
+            f"{name:<20} "
+            f"median {statistics.median(measurements):8.2f}ms  "
+            f"mean {statistics.mean(measurements):8.2f}ms  "
+            f"min {min(measurements):8.2f}ms  "
+            f"max {max(measurements):8.2f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("bucket", help="Name of the S3 bucket")
+    parser.add_argument("key", help="Key of a buildhub.json in that bucket")
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument(
+        "--signed",
+        action="store_true",
+        default=False,
+        help="Use signed requests (default is unsigned, for public buckets)",
+    )
+    args = parser.parse_args()
+    run(args.bucket, args.key, args.iterations, args.region, args.signed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Answer the simplest of the /api/search queries from PostgreSQL instead of
+Elasticsearch. Only this subset of the Elasticsearch query DSL is supported:
+
+* ``match_all``
+* ``term`` and ``terms`` on the keyword fields
+* ``range`` on the date fields
+* ``bool`` with only ``filter`` and/or ``must`` of the above
+* ``size`` and ``from``
+
+Anything else (aggregations, sorting, full-text queries etc.) raises
+Unsupported.
+"""
+
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
+from django.db.models import DateTimeField, Q
+from django.db.models.functions import Cast
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from buildhub.main.models import INDEXED_FIELDS, Build
+
+# The fields of buildhub.main.search.BuildDoc that are Keyword() and Date().
+KEYWORD_FIELDS = {
+    "build.id",
+    "source.product",
+    "source.repository",
+    "source.tree",
+    "source.revision",
+    "target.platform",
+    "target.os",
+    "target.locale",
+    "target.version",
+    "target.channel",
+    "download.url",
+    "download.mimetype",
+}
+DATE_FIELDS = {"build.date", "download.date"}
+
+# Elasticsearch refuses to page deeper than this (index.max_result_window).
+MAX_RESULT_WINDOW = 10000
+
+
+class Unsupported(Exception):
+    """When a search can't be answered from PostgreSQL."""
+
+
+def search(arguments):
+    """Return the search results, shaped like Elasticsearch's, of the
+    search (the parsed JSON body of an /api/search request)."""
+    t0 = time.time()
+    queryset, size, start = plan(arguments)
+    total = queryset.count()
+    end = start + size
+    hits = [
+        {
+            "_index": settings.ES_BUILD_INDEX,
+            "_type": "doc",
+            "_id": str(build.id),
+            "_score": 1.0,
+            "_source": build.to_search().to_dict(),
+        }
+        for build in queryset[start:end]
+    ]
+    return {
+        "took": int((time.time() - t0) * 1000),
+        "timed_out": False,
+        "hits": {"total": total, "max_score": 1.0 if hits else None, "hits": hits},
+    }
+
+
+def plan(arguments):
+    """Return the queryset, size and from of the search or raise
+    Unsupported."""
+    unsupported = set(arguments) - {"query", "size", "from"}
+    if unsupported:
+        raise Unsupported(f"Can't search by {', '.join(sorted(unsupported))}")
+    try:
+        size = int(arguments.get("size", 10))
+        start = int(arguments.get("from", 0))
+    except (TypeError, ValueError):
+        raise Unsupported("Invalid size or from")
+    if size < 0 or start < 0 or start + size > MAX_RESULT_WINDOW:
+        # Let Elasticsearch say what's wrong with it.
+        raise Unsupported("Invalid size or from")
+    planner = Planner()
+    q = planner.to_q(arguments.get("query", {"match_all": {}}))
+    queryset = Build.objects.all()
+    if planner.annotations:
+        queryset = queryset.annotate(**planner.annotations)
+    return queryset.filter(q).order_by("id"), size, start
+
+
+class Planner:
+    """Translates a query into a Q object. The dates, that have to be cast
+    before they can be compared, are annotations."""
+
+    def __init__(self):
+        self.annotations = {}
+
+    def to_q(self, query):
+        if not isinstance(query, dict) or len(query) != 1:
+            raise Unsupported(f"Not a query {query!r}")
+        ((kind, body),) = query.items()
+        if not isinstance(body, dict):
+            raise Unsupported(f"Not a {kind} query {body!r}")
+        if kind == "match_all":
+            return Q()
+        if kind == "bool":
+            return self.bool_q(body)
+        if kind in ("term", "terms"):
+            return self.term_q(kind, body)
+        if kind == "range":
+            return self.range_q(body)
+        raise Unsupported(f"Can't search by {kind}")
+
+    def bool_q(self, body):
+        unsupported = set(body) - {"filter", "must"}
+        if unsupported:
+            raise Unsupported(f"Can't search by bool {', '.join(sorted(unsupported))}")
+        q = Q()
+        for occur in ("filter", "must"):
+            clauses = body.get(occur, [])
+            if isinstance(clauses, dict):
+                clauses = [clauses]
+            for clause in clauses:
+                q &= self.to_q(clause)
+        return q
+
+    def term_q(self, kind, body):
+        if len(body) != 1:
+            raise Unsupported(f"Not a {kind} query {body!r}")
+        ((field, value),) = body.items()
+        if field not in KEYWORD_FIELDS:
+            raise Unsupported(f"Can't search by {kind} on {field}")
+        if kind == "term":
+            if isinstance(value, dict):
+                if set(value) != {"value"}:
+                    raise Unsupported(f"Not a term query {body!r}")
+                value = value["value"]
+            values = [value]
+        elif isinstance(value, list) and value:
+            values = value
+        else:
+            raise Unsupported(f"Not a terms query {body!r}")
+        if any(isinstance(value, (dict, list)) for value in values):
+            raise Unsupported(f"Not a {kind} query {body!r}")
+        # Keyword fields are strings, whatever the value is given as.
+        values = [str(value) for value in values]
+
+        column = INDEXED_FIELDS.get(field)
+        if column:
+            return Q(**{f"{column}__in": values})
+        # Each is a containment query, that the GIN index on 'build' serves.
+        parent, name = field.split(".")
+        q = Q()
+        for value in values:
+            q |= Q(build__contains={parent: {name: value}})
+        return q
+
+    def range_q(self, body):
+        if len(body) != 1:
+            raise Unsupported(f"Not a range query {body!r}")
+        ((field, bounds),) = body.items()
+        if field not in DATE_FIELDS:
+            raise Unsupported(f"Can't search by range on {field}")
+        if not isinstance(bounds, dict) or set(bounds) - {"gt", "gte", "lt", "lte"}:
+            raise Unsupported(f"Not a range query {body!r}")
+        parent, name = field.split(".")
+        annotation = f"{parent}_{name}"
+        self.annotations[annotation] = Cast(
+            KeyTextTransform(name, KeyTransform(parent, "build")), DateTimeField()
+        )
+        return Q(
+            **{
+                f"{annotation}__{operator}": parse_bound(value)
+                for operator, value in bounds.items()
+            }
+        )
+
+
+def parse_bound(value):
+    """Return the datetime of a date (YYYY-MM-DD) or datetime (ISO 8601)
+    range bound. Date math, like "now-1d", is not supported."""
+    parsed = None
+    if isinstance(value, str):
+        try:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                date = parse_date(value)
+                if date is not None:
+                    parsed = datetime.datetime.combine(date, datetime.time())
+        except ValueError:
+            pass
+    if parsed is None:
+        raise Unsupported(f"Not a date {value!r}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
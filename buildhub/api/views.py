@@ -8,9 +8,11 @@ import logging
 import markus
 from django import http
 from django.conf import settings
+from elasticsearch.exceptions import ConnectionError as ElasticsearchConnectionError
 from elasticsearch.exceptions import RequestError, TransportError
 from elasticsearch_dsl.exceptions import UnknownDslObject
 
+from buildhub.api import postgres
 from buildhub.main.models import Build
 from buildhub.main.search import BuildDoc
 
@@ -21,7 +23,9 @@ metrics = markus.get_metrics("buildhub2")
 
 @metrics.timer_decorator("api_search")
 def search(request):
-    """Proxy requests to Elasticsearch"""
+    """Proxy requests to Elasticsearch. Depending on
+    settings.SEARCH_POSTGRES, the simplest searches can be answered from
+    PostgreSQL instead (see buildhub.api.postgres)."""
     search = BuildDoc.search()
     arguments = None
     if request.method in ("POST",):
@@ -41,11 +45,23 @@ def search(request):
             except (UnknownDslObject, ValueError) as exception:
                 return http.JsonResponse({"error": exception.args[0]}, status=400)
     metrics.incr("api_search_requests", tags=[f"method:{request.method}"])
+    if settings.SEARCH_POSTGRES == "prefer":
+        http_response = search_postgres(arguments, "prefer")
+        if http_response:
+            return http_response
     try:
         response = search.execute()
     except RequestError as exception:
         return http.JsonResponse(exception.info, status=400)
     except TransportError as exception:
+        if is_unavailable(exception):
+            logger.warning(f"Elasticsearch is unavailable ({exception})")
+            if settings.SEARCH_POSTGRES in ("fallback", "prefer"):
+                http_response = search_postgres(arguments, "fallback")
+                if http_response:
+                    return http_response
+            if isinstance(exception, ElasticsearchConnectionError):
+                raise
         return http.JsonResponse(
             {"error": exception.info["error"]["root_cause"][0]["reason"]}, status=400
         )
@@ -56,6 +72,27 @@ def search(request):
     return http_response
 
 
+def search_postgres(arguments, reason):
+    """Return the response to the search from PostgreSQL, or None if the
+    search is not one that can be answered from PostgreSQL."""
+    try:
+        result = postgres.search(arguments or {})
+    except postgres.Unsupported as exception:
+        logger.info(f"Can't search PostgreSQL instead: {exception}")
+        return
+    metrics.incr("api_search_postgres", tags=[f"reason:{reason}"])
+    metrics.gauge("api_search_records", result["hits"]["total"])
+    return http.JsonResponse(result)
+
+
+def is_unavailable(exception):
+    """Return true if the Elasticsearch error is not about the search itself
+    but about Elasticsearch not being able to answer it."""
+    if isinstance(exception, ElasticsearchConnectionError):
+        return True
+    return isinstance(exception.status_code, int) and exception.status_code >= 500
+
+
 def records(request):
     context = {"builds": {"total": Build.objects.all().count()}}
     return http.JsonResponse(context)
@@ -2,147 +2,794 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
-import io
-import json
+import datetime
 import logging
+import os
+import queue
 import re
+import socket
 import statistics
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from urllib.parse import urlparse
 
 import boto3
 import markus
 from botocore import UNSIGNED
-from botocore.client import Config
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
-from buildhub.main.models import Build
+from buildhub.ingest.inventory import get_inventory_objs
+from buildhub.ingest.s3 import (
+    AdaptiveConcurrency,
+    AdaptiveS3Client,
+    ObjectTooLarge,
+    client_config,
+    fetch_json,
+)
+from buildhub.ingest.sqs import chunked
+from buildhub.main.models import BackfillShard, Build
 
 logger = logging.getLogger("buildhub")
 metrics = markus.get_metrics("buildhub2")
 
+# How many pages, per shard being listed, to keep in memory.
+SHARD_LOOKAHEAD_PAGES = 2
+
+# How many builds to insert per statement (and transaction).
+WRITE_BATCH_SIZE = 100
+
+# How many S3 objects `plan()` downloads to measure the download rate.
+PLAN_SAMPLE_SIZE = 20
+
 
 @metrics.timer_decorator("backfill")
-def backfill(s3_url, region_name=None, resume=False):
-    def download_and_insert(obj, maybe=False):
-        key = obj["Key"]
-        with io.BytesIO() as f:
-            # 'bucket_name' and 's3_client' is hoisted from the closure
-            s3_client.download_fileobj(bucket_name, key, f)
-            # After it has been populated by download_fileobj() we need to
-            # rewind it so we can send it to json.load().
-            f.seek(0)
-            # Before exiting this context (and freeing up the binary data),
-            # we turn it into a Python dict.
-            build = json.load(f)
-        inserted = Build.insert(
-            build=build, s3_object_key=obj["Key"], s3_object_etag=obj["ETag"]
-        )
-        if inserted:
-            logger.info(f"New Build inserted from backfill ({key})")
-            metrics.incr("backfill_inserted")
-        else:
-            logger.info(f"Key downloaded but not inserted again ({key})")
-            metrics.incr("backfill_not_inserted")
-        if maybe and not inserted:
-            # If this happens, it means that the build exists exactly with
-            # this build_hash already but the ETag isn't matching.
-            # Update the s3_object_* attributes
-            found = Build.objects.filter(
-                s3_object_key=key, build_hash=Build.get_build_hash(build)
-            )
-            found.update(s3_object_etag=obj["ETag"])
-
-    def is_equal_etags(etag1, etag2):
-        if etag1.startswith('"'):
-            etag1 = etag1[1:-1]
-        if etag2.startswith('"'):
-            etag2 = etag2[1:-1]
-        return etag1 == etag2
-
-    resume_info = None
-    if resume:
-        # Only try resume if the log file exists
-        try:
-            with open(settings.RESUME_DISK_LOG_FILE) as f:
-                resume_info = json.load(f)
-                logger.info(f"Resuming from key {resume_info!r}")
-        except FileNotFoundError:
-            logger.info(
-                f"No previous resume info found ({settings.RESUME_DISK_LOG_FILE})"
+def backfill(
+    s3_url,
+    region_name=None,
+    resume=False,
+    shard_depth=1,
+    listing_workers=1,
+    download_workers=1,
+    inventory=None,
+    prefixes=None,
+    since=None,
+    keys=None,
+):
+    s3_client, bucket_name, region_name = get_s3_client(
+        s3_url,
+        region_name,
+        listing_workers=listing_workers,
+        download_workers=download_workers,
+    )
+    batches, listing = get_batches(
+        s3_client,
+        bucket_name,
+        region_name,
+        shard_depth=shard_depth,
+        listing_workers=listing_workers,
+        resume=resume,
+        inventory=inventory,
+        prefixes=prefixes,
+        since=since,
+        keys=keys,
+    )
+    # The S3 objects are downloaded concurrently but all the database work
+    # is done by this thread.
+    executor = ThreadPoolExecutor(max_workers=download_workers)
+    count = 0
+    try:
+        for shard, objs in batches:
+            count += len(objs)
+            # Either we've never seen these keys in our database before, or
+            # the Etag has changed!
+            new, changed = diff(shard, objs)
+            todo = new + changed
+
+            inserted = 0
+            if todo:
+                # They're all downloaded before touching the database so no
+                # transaction is held open while waiting for S3.
+                t0 = time.time()
+                builds = list(
+                    executor.map(partial(download, s3_client, bucket_name), todo)
+                )
+                t1 = time.time()
+                metrics.incr("backfill_downloaded", len(todo))
+                metrics.gauge("backfill_downloads_per_second", len(todo) / (t1 - t0))
+
+                rows = []
+                for obj, build in zip(todo, builds):
+                    if build is not None:
+                        Build.validate_build(build)
+                        rows.append(
+                            {
+                                "build": build,
+                                "s3_object_key": obj["Key"],
+                                "s3_object_etag": obj["ETag"],
+                            }
+                        )
+                for chunk in chunked(rows, WRITE_BATCH_SIZE):
+                    inserted += insert_rows(chunk)
+            if shard:
+                listing.checkpoint(shard, objs, len(todo), inserted)
+    finally:
+        batches.close()
+        executor.shutdown(wait=True)
+    logger.info(f"Analyzed {count} keys (called buildhub.json) from S3")
+
+
+def plan(
+    s3_url,
+    region_name=None,
+    shard_depth=1,
+    listing_workers=1,
+    download_workers=1,
+    inventory=None,
+    prefixes=None,
+    since=None,
+    keys=None,
+    sample_size=PLAN_SAMPLE_SIZE,
+):
+    """List and compare the S3 keys, exactly like `backfill`, but don't
+    download, insert or checkpoint anything. Return a dict of how many keys
+    are new, changed and unchanged per shard prefix and an estimate of how
+    long the backfill would take.
+
+    To measure the download rate, up to 'sample_size' of the S3 objects that
+    would need to be downloaded are downloaded (and thrown away).
+    """
+    s3_client, bucket_name, region_name = get_s3_client(
+        s3_url,
+        region_name,
+        listing_workers=listing_workers,
+        download_workers=download_workers,
+    )
+    batches, _ = get_batches(
+        s3_client,
+        bucket_name,
+        region_name,
+        shard_depth=shard_depth,
+        listing_workers=listing_workers,
+        inventory=inventory,
+        prefixes=prefixes,
+        since=since,
+        keys=keys,
+        checkpoints=False,
+    )
+    counts = {}
+    sample = []
+    t0 = time.time()
+    try:
+        for shard, objs in batches:
+            new, changed = diff(shard, objs)
+            prefix_counts = counts.setdefault(
+                shard.prefix if shard else "", {"new": 0, "changed": 0, "unchanged": 0}
             )
+            prefix_counts["new"] += len(new)
+            prefix_counts["changed"] += len(changed)
+            prefix_counts["unchanged"] += len(objs) - len(new) - len(changed)
+            needed = sample_size - len(sample)
+            sample.extend((new + changed)[:needed])
+    finally:
+        batches.close()
+    listing_seconds = time.time() - t0
+
+    listed = sum(sum(prefix_counts.values()) for prefix_counts in counts.values())
+    todo = sum(c["new"] + c["changed"] for c in counts.values())
+    download_rate = None
+    estimated_seconds = listing_seconds
+    if sample:
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            list(executor.map(partial(download, s3_client, bucket_name), sample))
+        download_rate = len(sample) / max(time.time() - t0, 0.001)
+        estimated_seconds += todo / download_rate
+    return {
+        "prefixes": counts,
+        "listed": listed,
+        "listing_seconds": listing_seconds,
+        "download_rate": download_rate,
+        "estimated_seconds": estimated_seconds,
+    }
 
-    # Prepare a massive dict every existing known Build by their 's3_object_key'.
-    existing = get_builds_existing_map()
-    existing_set = set(existing.keys())
-    logger.info(f"We currently have {len(existing_set)} s3_object_keys in our database")
+
+def get_s3_client(s3_url, region_name=None, listing_workers=1, download_workers=1):
+    """Return the S3 client, the bucket name and the region name of the
+    S3 bucket URL. How many S3 objects are listed and downloaded at the same
+    time is adapted to how S3 copes, up to the number of workers."""
     bucket_name = urlparse(s3_url).path.split("/")[-1]
     if not region_name:
         try:
             region_name = re.findall(r"s3[\.-](.*?)\.amazonaws\.com", s3_url)[0]
         except IndexError:
             region_name = None
-    connection_config = None
+    # The one client is shared by all the listing and download threads. Its
+    # connection pool must be big enough for all of them or urllib3 keeps
+    # throwing away connections and making new (TLS) ones.
+    pool_size = listing_workers + download_workers
     if settings.UNSIGNED_S3_CLIENT:
-        connection_config = Config(signature_version=UNSIGNED)
-    s3_client = boto3.client("s3", region_name, config=connection_config)
-    count = 0
-    for objs in get_matching_s3_objs(
+        connection_config = client_config(
+            signature_version=UNSIGNED, max_pool_connections=pool_size
+        )
+    else:
+        connection_config = client_config(max_pool_connections=pool_size)
+    s3_client = AdaptiveS3Client(
+        boto3.client("s3", region_name, config=connection_config),
+        AdaptiveConcurrency("get", download_workers),
+        AdaptiveConcurrency("list", listing_workers),
+    )
+    return s3_client, bucket_name, region_name
+
+
+def get_batches(
+    s3_client,
+    bucket_name,
+    region_name,
+    shard_depth=1,
+    listing_workers=1,
+    resume=False,
+    inventory=None,
+    prefixes=None,
+    since=None,
+    keys=None,
+    checkpoints=True,
+):
+    """Return an iterator of (shard, batch of S3 objects), and the
+    ShardedListing if that's where they come from. The shard is None when
+    the S3 objects don't come from listing the bucket."""
+    if inventory:
+        # The S3 Inventory reports are never in a public bucket.
+        batches = (
+            (None, objs)
+            for objs in get_inventory_objs(
+                boto3.client("s3", region_name), inventory, suffix="buildhub.json"
+            )
+        )
+        return batches, None
+    if keys is not None:
+        batches = (
+            (None, objs)
+            for objs in get_keys_objs(
+                s3_client,
+                bucket_name,
+                keys,
+                suffix="buildhub.json",
+                since=since,
+                workers=listing_workers,
+            )
+        )
+        return batches, None
+    listing = ShardedListing(
         s3_client,
         bucket_name,
         suffix="buildhub.json",
         max_keys=1000,
-        resume_info=resume_info,
-    ):
-        keys = {x["Key"]: x for x in objs}
-        keys_set = set(keys.keys())
-        count += len(keys_set)
-        # Of the keys that we've never seen in our database before,
-        # this is a slam dunk.
-        with transaction.atomic():
-            for key in keys_set - existing_set:
-                download_and_insert(keys[key])
-                keys.pop(key)
+        shard_depth=shard_depth,
+        workers=listing_workers,
+        resume=resume,
+        prefixes=expand_dated_prefixes(prefixes or [""], since),
+        since=since,
+        checkpoints=checkpoints,
+    )
+    return iter(listing), listing
 
-            for key in keys:
-                etag_before = existing[key]
-                if is_equal_etags(etag_before, keys[key]["ETag"]):
-                    continue
-                # The Etag has changed!
-                download_and_insert(keys[key], maybe=True)
-    logger.info(f"Analyzed {count} keys (called buildhub.json) from S3")
+
+def download(s3_client, bucket_name, obj):
+    """Return the build in the S3 object or None if it can't be had.
+    This is run in the download workers so it must not touch the
+    database."""
+    key = obj["Key"]
+    if obj.get("Size", 0) > settings.S3_MAX_OBJECT_SIZE:
+        logger.warning(f"Not downloading {key} because it's too large")
+        return
+    try:
+        return fetch_json(
+            s3_client, bucket_name, key, max_size=settings.S3_MAX_OBJECT_SIZE
+        )
+    except ObjectTooLarge as exception:
+        logger.warning(f"Not downloading {exception}")
+
+
+def diff(shard, objs):
+    """Return the S3 objects whose keys we've never seen before and those
+    whose ETag has changed."""
+    existing = shard.existing if shard else None
+    if existing is None:
+        # Not sorted, so the keys are looked up per batch.
+        known = get_existing_etags([obj["Key"] for obj in objs])
+    new = []
+    changed = []
+    for obj in objs:
+        if existing is None:
+            etags = known.get(obj["Key"], set())
+        else:
+            etags = existing.get(obj["Key"])
+        if not etags:
+            new.append(obj)
+        elif not any(is_equal_etags(etag, obj["ETag"]) for etag in etags):
+            changed.append(obj)
+    return new, changed
+
+
+def is_equal_etags(etag1, etag2):
+    if not etag1 or not etag2:
+        return False
+    if etag1.startswith('"'):
+        etag1 = etag1[1:-1]
+    if etag2.startswith('"'):
+        etag2 = etag2[1:-1]
+    return etag1 == etag2
+
+
+def iter_existing_keys(prefix=""):
+    """Yield the (s3_object_key, s3_object_etag) of every build, whose key
+    starts with the prefix, ordered by the key the same way S3 lists keys
+    (by their UTF-8 bytes). It's streamed with a server-side cursor so it's
+    never all in memory."""
+    sql = f"""
+        SELECT s3_object_key, s3_object_etag FROM {Build._meta.db_table}
+        WHERE s3_object_key IS NOT NULL
+    """
+    params = []
+    if prefix:
+        # The same as `LIKE 'prefix%'` but it can use the index.
+        sql += """
+            AND s3_object_key COLLATE "C" >= %s
+            AND s3_object_key COLLATE "C" < %s
+        """
+        params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+    sql += ' ORDER BY s3_object_key COLLATE "C"'
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        yield from cursor
+
+
+def insert_rows(rows):
+    """Insert the builds, in one statement, or, if they already exist under
+    the same S3 key, update their ETag."""
+    builds = Build.insert_many(rows, update_etag=True)
+    inserted = 0
+    for build in builds:
+        if build.inserted:
+            logger.info(f"New Build inserted from backfill ({build.s3_object_key})")
+            inserted += 1
+    metrics.incr("backfill_inserted", inserted)
+    metrics.incr("backfill_etag_updated", len(builds) - inserted)
+    metrics.incr("backfill_not_inserted", len(rows) - len(builds))
+    return inserted
 
 
-def get_builds_existing_map():
-    existing = {}
-    qs = Build.objects.filter(s3_object_key__isnull=False).only(
+def get_existing_etags(keys):
+    """Return a dict of the set of ETags we have for each of these S3 keys."""
+    etags = {}
+    qs = Build.objects.filter(s3_object_key__in=keys).values_list(
         "s3_object_key", "s3_object_etag"
     )
+    for key, etag in qs:
+        etags.setdefault(key, set()).add(etag)
+    return etags
+
+
+class ExistingKeys:
+    """The ETags we have of S3 keys. Looked up by merge-joining the S3 keys,
+    which must be looked up in the order S3 lists them, with a stream of
+    (s3_object_key, s3_object_etag) sorted the same way.
+    That way the memory used doesn't depend on how many builds we have."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.current = next(self.rows, None)
+        self.last_key = None
+        self.last_etags = set()
+
+    def get(self, key):
+        """Return the set of ETags we have for this S3 key."""
+        if self.last_key is not None and key <= self.last_key:
+            if key == self.last_key:
+                return self.last_etags
+            # Out of order, so it can't be in the stream anymore.
+            logger.warning(f"S3 key {key!r} listed out of order")
+            return set(
+                Build.objects.filter(s3_object_key=key).values_list(
+                    "s3_object_etag", flat=True
+                )
+            )
+        while self.current is not None and self.current[0] < key:
+            self.current = next(self.rows, None)
+        etags = set()
+        # Several builds (e.g. derived ones) can have the same key.
+        while self.current is not None and self.current[0] == key:
+            etags.add(self.current[1])
+            self.current = next(self.rows, None)
+        self.last_key = key
+        self.last_etags = etags
+        return etags
+
+    def close(self):
+        if hasattr(self.rows, "close"):
+            self.rows.close()
+
+
+def expand_dated_prefixes(prefixes, since, today=None):
+    """Return the prefixes with every '{YYYY}/{MM}' replaced by every year
+    and month from the 'since' date until today. For example, since
+    2019-11-15, 'pub/firefox/nightly/{YYYY}/{MM}/' becomes
+    'pub/firefox/nightly/2019/11/', 'pub/firefox/nightly/2019/12/',
+    'pub/firefox/nightly/2020/01/' etc."""
+    expanded = []
+    for prefix in prefixes:
+        if "{YYYY}" not in prefix and "{MM}" not in prefix:
+            expanded.append(prefix)
+            continue
+        if not since:
+            raise ValueError(f"Can't use the dated prefix {prefix!r} without a date")
+        today = today or datetime.date.today()
+        year, month = since.year, since.month
+        while (year, month) <= (today.year, today.month):
+            expanded.append(
+                prefix.replace("{YYYY}", f"{year:04}").replace("{MM}", f"{month:02}")
+            )
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return expanded
+
+
+def get_keys_objs(
+    s3_client, bucket, keys, suffix="", since=None, workers=1, batch_size=1000
+):
+    """Return an iterator of the S3 objects, in batches, of these S3 keys.
+    Keys that don't end with the suffix, or that don't exist, are skipped."""
+
+    def get_obj(key):
+        # Listing, rather than a HEAD, gives the same kind of dict as when
+        # listing the whole bucket.
+        resp = s3_client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        for obj in resp.get("Contents", []):
+            if obj["Key"] == key:
+                return obj
+        logger.warning(f"S3 key {key!r} not found")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunked(keys, batch_size):
+            objs = [
+                obj
+                for obj in executor.map(
+                    get_obj, [key for key in chunk if key.endswith(suffix)]
+                )
+                if obj and not (since and obj["LastModified"] < since)
+            ]
+            metrics.incr("backfill_listed", len(chunk))
+            if objs:
+                metrics.incr("backfill_matched", len(objs))
+                yield objs
+
+
+def discover_shards(s3_client, bucket, prefix="", depth=1):
+    """Return the (prefix, recursive) of the shards, `depth` levels of "/"
+    below `prefix`, that the bucket can be split into so they can be listed
+    independently. A shard that isn't recursive is only the keys directly in
+    its prefix. Those are the keys found on the way down."""
+    if depth <= 0:
+        return [(prefix, True)]
+    shards = []
+    direct = False
+    kwargs = {"Bucket": bucket, "Prefix": prefix, "Delimiter": "/"}
     while True:
-        for build in qs.order_by("id")[:1000]:
-            existing[build.s3_object_key] = build.s3_object_etag
-            qs = qs.filter(id__gt=build.id)
-        else:
+        resp = s3_client.list_objects_v2(**kwargs)
+        if resp.get("Contents"):
+            direct = True
+        for common_prefix in resp.get("CommonPrefixes", []):
+            shards.extend(
+                discover_shards(
+                    s3_client, bucket, prefix=common_prefix["Prefix"], depth=depth - 1
+                )
+            )
+        try:
+            kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+        except KeyError:
             break
+    if direct:
+        shards.insert(0, (prefix, False))
+    return shards
+
+
+class ShardedListing:
+    """
+    Iterate over (shard, batch of S3 objects) of every shard of the bucket
+    (see `discover_shards`) that hasn't been finished yet.
+
+    The shards are BackfillShard rows. Before a shard is listed it's leased,
+    so several backfill processes, on different hosts, can split the bucket
+    between them. Up to `workers` shards are listed concurrently. After a
+    batch has been dealt with, `checkpoint()` records how far into the shard
+    we got so it can be resumed from there.
+
+    With `checkpoints=False` the BackfillShard objects are never saved. Every
+    shard is listed, none are leased and nothing is recorded.
+
+    Each shard also gets an `existing` attribute which is an ExistingKeys of
+    all the keys we have in that shard, or None if they need to be looked up
+    some other way.
+    """
 
-    return existing
+    def __init__(
+        self,
+        s3_client,
+        bucket,
+        suffix="",
+        max_keys=1000,
+        shard_depth=1,
+        workers=1,
+        resume=False,
+        prefixes=("",),
+        since=None,
+        checkpoints=True,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.suffix = suffix
+        self.max_keys = max_keys
+        self.shard_depth = shard_depth
+        self.workers = workers
+        self.resume = resume
+        self.prefixes = prefixes
+        self.since = since
+        self.checkpoints = checkpoints
+        # The shards of this run, out of all the shards of the bucket.
+        self.scope = Q()
+        for prefix in prefixes:
+            self.scope |= Q(prefix__startswith=prefix)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease = datetime.timedelta(seconds=settings.BACKFILL_LEASE_SECONDS)
+        self.pages = queue.Queue(workers * SHARD_LOOKAHEAD_PAGES)
+        self.stop = threading.Event()
+        self.in_flight = {}
+
+    def __iter__(self):
+        self.prepare()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        renew_every = self.lease.total_seconds() / 3
+        last_renewal = time.time()
+        try:
+            while True:
+                while len(self.in_flight) < self.workers:
+                    shard = self.claim()
+                    if shard is None:
+                        break
+                    self.in_flight[shard.id] = shard
+                    executor.submit(self.list_shard, shard)
+                if not self.in_flight:
+                    break
+                # On a timer, whether anything was yielded or not. Listing
+                # can go on for a long time without a single match, e.g.
+                # old keys with --since or trees without any buildhub.json.
+                if time.time() - last_renewal >= renew_every:
+                    self.renew()
+                    last_renewal = time.time()
+                try:
+                    shard, batch = self.pages.get(timeout=renew_every)
+                except queue.Empty:
+                    continue
+                if isinstance(batch, Exception):
+                    raise batch
+                if shard.id not in self.in_flight:
+                    # We've lost the lease on it.
+                    continue
+                if batch is None:
+                    self.finish(shard)
+                    continue
+                yield shard, batch
+        finally:
+            self.stop.set()
+            self.release()
+            executor.shutdown(wait=True)
+
+    def prepare(self):
+        """Create the BackfillShard rows, if they don't already exist."""
+        shards = []
+        for prefix in self.prefixes:
+            shards.extend(
+                discover_shards(
+                    self.s3_client, self.bucket, prefix=prefix, depth=self.shard_depth
+                )
+            )
+        if not self.checkpoints:
+            # Only kept in memory, and never saved, so that nothing is
+            # remembered about this run.
+            self.pending = [
+                BackfillShard(
+                    id=i, s3_bucket_name=self.bucket, prefix=prefix, recursive=recursive
+                )
+                for i, (prefix, recursive) in enumerate(shards)
+            ]
+            logger.info(f"{len(shards):,} shards of {self.bucket!r}")
+            return
+        if not self.resume:
+            BackfillShard.objects.filter(s3_bucket_name=self.bucket).filter(
+                self.scope
+            ).delete()
+        BackfillShard.objects.bulk_create(
+            [
+                BackfillShard(
+                    s3_bucket_name=self.bucket, prefix=prefix, recursive=recursive
+                )
+                for prefix, recursive in shards
+            ],
+            # Another process might have just created them.
+            ignore_conflicts=True,
+        )
+        unfinished = (
+            BackfillShard.objects.filter(
+                s3_bucket_name=self.bucket, finished_at__isnull=True
+            )
+            .filter(self.scope)
+            .count()
+        )
+        logger.info(
+            f"{len(shards):,} shards of {self.bucket!r}, {unfinished:,} unfinished. "
+            f"Listing {self.workers} at a time."
+        )
+
+    def claim(self):
+        """Lease the next shard nobody else is working on, if any."""
+        now = timezone.now()
+        if not self.checkpoints:
+            shard = self.pending.pop(0) if self.pending else None
+        else:
+            shard = self.lease_next(now)
+        if shard is None:
+            return
+        if shard.last_key:
+            logger.info(f"Resuming shard {shard.prefix!r} after {shard.last_key!r}")
+        shard.existing = None
+        if shard.recursive:
+            shard.existing = ExistingKeys(iter_existing_keys(shard.prefix))
+        return shard
+
+    def lease_next(self, now):
+        with transaction.atomic():
+            shard = (
+                BackfillShard.objects.select_for_update(skip_locked=True)
+                .filter(s3_bucket_name=self.bucket, finished_at__isnull=True)
+                .filter(self.scope)
+                .filter(Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now))
+                # They're created in the order S3 lists them.
+                .order_by("id")
+                .first()
+            )
+            if shard is None:
+                return
+            shard.lease_owner = self.owner
+            shard.lease_expires_at = now + self.lease
+            if not shard.started_at:
+                shard.started_at = now
+            shard.save()
+        return shard
+
+    def list_shard(self, shard):
+        """Put the batches of the shard in the queue. This is run in the
+        listing workers so it must not touch the database."""
+        try:
+            for objs in get_matching_s3_objs(
+                self.s3_client,
+                self.bucket,
+                prefix=shard.prefix,
+                delimiter=None if shard.recursive else "/",
+                suffix=self.suffix,
+                max_keys=self.max_keys,
+                start_after=shard.last_key,
+                since=self.since,
+            ):
+                if self.stop.is_set() or shard.id not in self.in_flight:
+                    return
+                self.put((shard, objs))
+            self.put((shard, None))
+        except Exception as exception:
+            self.put((shard, exception))
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def checkpoint(self, shard, objs, downloaded, inserted):
+        """Remember that the shard has been dealt with up to, and including,
+        the last of these objects."""
+        if not self.checkpoints:
+            return
+        now = timezone.now()
+        updated = BackfillShard.objects.filter(
+            id=shard.id, lease_owner=self.owner
+        ).update(
+            last_key=objs[-1]["Key"],
+            matched_count=F("matched_count") + len(objs),
+            downloaded_count=F("downloaded_count") + downloaded,
+            inserted_count=F("inserted_count") + inserted,
+            lease_expires_at=now + self.lease,
+            modified_at=now,
+        )
+        if not updated:
+            logger.warning(
+                f"Lost the lease on shard {shard.prefix!r}. Someone else took it."
+            )
+            self.drop(shard)
+
+    def finish(self, shard):
+        if self.checkpoints:
+            now = timezone.now()
+            BackfillShard.objects.filter(id=shard.id, lease_owner=self.owner).update(
+                finished_at=now,
+                lease_owner=None,
+                lease_expires_at=None,
+                modified_at=now,
+            )
+        logger.info(f"Finished shard {shard.prefix!r}")
+        self.drop(shard)
+
+    def drop(self, shard):
+        self.in_flight.pop(shard.id, None)
+        if shard.existing is not None:
+            shard.existing.close()
+
+    def renew(self):
+        """Extend the leases of all the shards we're working on."""
+        if not self.checkpoints:
+            return
+        BackfillShard.objects.filter(
+            id__in=list(self.in_flight), lease_owner=self.owner
+        ).update(lease_expires_at=timezone.now() + self.lease)
+
+    def release(self):
+        """Let go of the shards we're working on so that somebody else can
+        continue them right away."""
+        if not self.in_flight:
+            return
+        if self.checkpoints:
+            try:
+                BackfillShard.objects.filter(
+                    id__in=list(self.in_flight), lease_owner=self.owner
+                ).update(lease_owner=None, lease_expires_at=None)
+            except Exception:
+                logger.exception("Unable to release the backfill shards")
+        for shard in list(self.in_flight.values()):
+            self.drop(shard)
 
 
 def get_matching_s3_objs(
-    s3_client, bucket, prefix="", suffix="", max_keys=1000, resume_info=None
+    s3_client,
+    bucket,
+    prefix="",
+    suffix="",
+    max_keys=1000,
+    start_after=None,
+    delimiter=None,
+    since=None,
 ):
     """
     Return an iterator of S3 objects in batches.
 
     :param bucket: Name of the S3 bucket.
     :param prefix: Only fetch keys that start with this prefix (optional).
+    :param delimiter: Only fetch keys that don't have this after the
+        prefix (optional).
     :param suffix: Only fetch keys that end with this suffix (optional).
+    :param start_after: Only fetch keys that come after this key (optional).
+    :param since: Only fetch objects last modified at or after this
+        datetime (optional).
     """
     loops = 0
-    misses = hits = 0
+    listed = misses = hits = 0
     kwargs = {"Bucket": bucket, "MaxKeys": max_keys, "Prefix": prefix}
-    if resume_info:
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    if start_after:
         # From
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.list_objects_v2
         #
@@ -150,25 +797,27 @@ def get_matching_s3_objs(
         # listing from. Amazon S3 starts listing after this specified key. StartAfter
         # can be any key in the bucket
         #
-        kwargs["StartAfter"] = resume_info["key"]
-        loops = resume_info["loops"]
+        kwargs["StartAfter"] = start_after
 
     speeds = []
+    shard_t0 = time.time()
 
     while True:
         t0 = time.time()
         resp = s3_client.list_objects_v2(**kwargs)
-        metrics.incr("backfill_listed", len(resp["Contents"]))
+        contents = resp.get("Contents", [])
+        metrics.incr("backfill_listed", len(contents))
+        listed += len(contents)
         matched = []
 
-        last_key = None
-        for obj in resp["Contents"]:
-            if not suffix or obj["Key"].endswith(suffix):
+        for obj in contents:
+            if since and obj["LastModified"] < since:
+                misses += 1
+            elif not suffix or obj["Key"].endswith(suffix):
                 matched.append(obj)
                 hits += 1
             else:
                 misses += 1
-            last_key = obj["Key"]
         if matched:
             metrics.incr("backfill_matched", len(matched))
             yield matched
@@ -179,6 +828,7 @@ def get_matching_s3_objs(
         average_speed = statistics.mean(speeds)
         logger.info(
             f"Found {len(matched)} S3 keys on page {format(loops + 1, ',')} "
+            f"of {prefix!r} "
             f"({speed:.1f} keys/s ~ {average_speed:.1f} keys/s average)"
         )
         try:
@@ -187,12 +837,10 @@ def get_matching_s3_objs(
             break
         loops += 1
 
-        if last_key:
-            with open(settings.RESUME_DISK_LOG_FILE, "w") as f:
-                json.dump(
-                    {"key": last_key, "loops": loops, "time": int(time.time())}, f
-                )
-
+    shard_speed = listed / max(time.time() - shard_t0, 0.001)
+    logger.info(
+        f"Listed {format(listed, ',')} keys of {prefix!r} ({shard_speed:.1f} keys/s)"
+    )
     logger.info(
         "Skipped {} keys that did NOT match buildhub.json".format(format(misses, ","))
     )
@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+from urllib.parse import unquote_plus, urlparse
+
+import markus
+
+logger = logging.getLogger("buildhub")
+metrics = markus.get_metrics("buildhub2")
+
+
+class InventoryError(Exception):
+    """When an S3 Inventory manifest can't be used."""
+
+
+def load_manifest(s3_client, manifest):
+    """Return the parsed S3 Inventory manifest.json from a local file path or
+    an s3://bucket/key URL."""
+    if manifest.startswith("s3://"):
+        parsed = urlparse(manifest)
+        response = s3_client.get_object(
+            Bucket=parsed.netloc, Key=parsed.path.lstrip("/")
+        )
+        return json.loads(response["Body"].read())
+    with open(manifest) as f:
+        return json.load(f)
+
+
+def get_inventory_objs(s3_client, manifest, suffix="", batch_size=1000):
+    """
+    Return an iterator of S3 objects in batches, like `get_matching_s3_objs`,
+    but read from the (gzipped CSV) files of an S3 Inventory report instead of
+    listing the bucket.
+
+    If the manifest is a local file, the inventory files are expected to be
+    in the same directory as it. If it's an s3:// URL they're read from the
+    inventory's destination bucket.
+
+    Note! The objects are not in the same order as S3 lists them.
+    """
+    info = load_manifest(s3_client, manifest)
+    if info.get("fileFormat", "CSV").upper() != "CSV":
+        raise InventoryError(
+            f"Only CSV inventories are supported, not {info['fileFormat']!r}"
+        )
+    columns = [column.strip() for column in info["fileSchema"].split(",")]
+    for column in ("Key", "ETag"):
+        if column not in columns:
+            raise InventoryError(f"The inventory doesn't have the {column!r} column")
+    key_index = columns.index("Key")
+    etag_index = columns.index("ETag")
+    size_index = columns.index("Size") if "Size" in columns else None
+
+    matched = []
+    for inventory_file in info["files"]:
+        logger.info(f"Reading S3 inventory file {inventory_file['key']}")
+        listed = 0
+        with open_inventory_file(s3_client, manifest, info, inventory_file) as f:
+            for row in csv.reader(f):
+                listed += 1
+                # In the CSV files the keys are URL-encoded.
+                key = unquote_plus(row[key_index])
+                if suffix and not key.endswith(suffix):
+                    continue
+                obj = {"Key": key, "ETag": row[etag_index]}
+                if size_index is not None and row[size_index]:
+                    obj["Size"] = int(row[size_index])
+                matched.append(obj)
+                if len(matched) >= batch_size:
+                    metrics.incr("backfill_matched", len(matched))
+                    yield matched
+                    matched = []
+        metrics.incr("backfill_listed", listed)
+    if matched:
+        metrics.incr("backfill_matched", len(matched))
+        yield matched
+
+
+def open_inventory_file(s3_client, manifest, info, inventory_file):
+    """Return the inventory file, decompressed, as a text file object."""
+    if manifest.startswith("s3://"):
+        # The destinationBucket is an ARN like 'arn:aws:s3:::name'
+        bucket_name = info["destinationBucket"].split(":")[-1]
+        response = s3_client.get_object(Bucket=bucket_name, Key=inventory_file["key"])
+        fileobj = gzip.GzipFile(fileobj=response["Body"])
+    else:
+        fileobj = gzip.open(
+            os.path.join(
+                os.path.dirname(manifest), os.path.basename(inventory_file["key"])
+            )
+        )
+    return io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
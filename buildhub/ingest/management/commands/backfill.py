@@ -3,11 +3,17 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import sys
 import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from buildhub.ingest.backfill import backfill
+from django.utils import timezone
+from buildhub.ingest.backfill import PLAN_SAMPLE_SIZE, backfill, plan
+
+
+def since_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
 
 
 class Command(BaseCommand):
@@ -24,11 +30,123 @@ class Command(BaseCommand):
             default=False,
             help="Will try to continue where it last fell through.",
         )
+        parser.add_argument(
+            "--shard-depth",
+            type=int,
+            default=settings.BACKFILL_SHARD_DEPTH,
+            help='Split the S3 bucket by the prefixes this many "/" deep.',
+        )
+        parser.add_argument(
+            "--listing-workers",
+            type=int,
+            default=settings.BACKFILL_LISTING_WORKERS,
+            help="Number of shards of the S3 bucket to list concurrently.",
+        )
+        parser.add_argument(
+            "--download-workers",
+            type=int,
+            default=settings.BACKFILL_DOWNLOAD_WORKERS,
+            help="Number of S3 objects to download concurrently.",
+        )
+        parser.add_argument(
+            "--inventory",
+            help=(
+                "Path or s3:// URL to the manifest.json of an S3 Inventory "
+                "report to read the S3 keys from, instead of listing the bucket."
+            ),
+        )
+        parser.add_argument(
+            "--prefix",
+            action="append",
+            dest="prefixes",
+            help=(
+                "Only list the S3 keys that start with this. Can be repeated. "
+                "'{YYYY}/{MM}' is replaced by every month since --since."
+            ),
+        )
+        parser.add_argument(
+            "--since",
+            type=since_date,
+            help=(
+                "Only consider S3 objects modified since this date (YYYY-MM-DD). "
+                "Without --prefix, only the dated nightly directories "
+                "(settings.BACKFILL_DATED_PREFIXES) are listed."
+            ),
+        )
+        parser.add_argument(
+            "--keys-from",
+            help="File with the S3 keys, one per line, to consider ('-' for stdin).",
+        )
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            default=False,
+            help=(
+                "Only list the S3 keys and compare them with the database. "
+                "Report how many are new, changed and unchanged and estimate "
+                "how long the backfill would take."
+            ),
+        )
+        parser.add_argument(
+            "--plan-sample",
+            type=int,
+            default=PLAN_SAMPLE_SIZE,
+            help="Number of S3 objects to download, with --plan, to time it.",
+        )
 
     def handle(self, *args, **options):
+        if options["inventory"] and options["resume"]:
+            raise CommandError("Can't --resume when reading an --inventory")
+        if options["keys_from"] and options["resume"]:
+            raise CommandError("Can't --resume when reading --keys-from")
+        if options["inventory"] and (options["since"] or options["prefixes"]):
+            raise CommandError("Can't use --since or --prefix with --inventory")
+        if options["keys_from"] and options["inventory"]:
+            raise CommandError("Can't use --keys-from with --inventory")
+        if options["keys_from"] and options["prefixes"]:
+            raise CommandError("Can't use --prefix with --keys-from")
+        keys = None
+        if options["keys_from"]:
+            if options["keys_from"] == "-":
+                keys = [line.strip() for line in sys.stdin]
+            else:
+                with open(options["keys_from"]) as f:
+                    keys = [line.strip() for line in f]
+            keys = [key for key in keys if key]
+        prefixes = options["prefixes"]
+        if options["since"] and not prefixes:
+            prefixes = settings.BACKFILL_DATED_PREFIXES
+        if not options["since"] and any("{" in prefix for prefix in prefixes or []):
+            raise CommandError("A dated --prefix needs a --since")
+        if options["plan"]:
+            if options["resume"]:
+                raise CommandError("Can't --resume a --plan")
+            report = plan(
+                settings.S3_BUCKET_URL,
+                shard_depth=options["shard_depth"],
+                listing_workers=options["listing_workers"],
+                download_workers=options["download_workers"],
+                inventory=options["inventory"],
+                prefixes=prefixes,
+                since=options["since"],
+                keys=keys,
+                sample_size=options["plan_sample"],
+            )
+            self.print_plan(report)
+            return
         t0 = time.time()
         try:
-            backfill(settings.S3_BUCKET_URL, resume=options["resume"])
+            backfill(
+                settings.S3_BUCKET_URL,
+                resume=options["resume"],
+                shard_depth=options["shard_depth"],
+                listing_workers=options["listing_workers"],
+                download_workers=options["download_workers"],
+                inventory=options["inventory"],
+                prefixes=prefixes,
+                since=options["since"],
+                keys=keys,
+            )
         finally:
             t1 = time.time()
             self.stdout.write(
@@ -38,3 +156,46 @@ class Command(BaseCommand):
                     )
                 )
             )
+
+    def print_plan(self, report):
+        line = "{:<60} {:>12} {:>12} {:>12}"
+        self.stdout.write(line.format("PREFIX", "NEW", "CHANGED", "UNCHANGED"))
+        totals = {"new": 0, "changed": 0, "unchanged": 0}
+        for prefix, counts in sorted(report["prefixes"].items()):
+            self.stdout.write(
+                line.format(
+                    prefix or "/",
+                    f"{counts['new']:,}",
+                    f"{counts['changed']:,}",
+                    f"{counts['unchanged']:,}",
+                )
+            )
+            for key in totals:
+                totals[key] += counts[key]
+        self.stdout.write(
+            line.format(
+                "TOTAL",
+                f"{totals['new']:,}",
+                f"{totals['changed']:,}",
+                f"{totals['unchanged']:,}",
+            )
+        )
+        seconds = report["listing_seconds"]
+        self.stdout.write(
+            "Listed {:,} keys in {} ({:.1f} keys/s)".format(
+                report["listed"],
+                datetime.timedelta(seconds=int(seconds)),
+                report["listed"] / max(seconds, 0.001),
+            )
+        )
+        if report["download_rate"]:
+            self.stdout.write(
+                "Downloaded {:.1f} objects/s".format(report["download_rate"])
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Estimated backfill time: {}".format(
+                    datetime.timedelta(seconds=int(report["estimated_seconds"]))
+                )
+            )
+        )
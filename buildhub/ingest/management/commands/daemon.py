@@ -4,7 +4,7 @@
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from buildhub.ingest.sqs import start
+from buildhub.ingest.sqs import start, supervise
 
 
 class Command(BaseCommand):
@@ -14,13 +14,34 @@ class Command(BaseCommand):
         "of this command's responsibility to start it again."
     )
 
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help=(
+                "Number of daemon processes to fork. Crashed processes are "
+                "restarted. Default is 1 which means no forking."
+            ),
+        )
+
     def handle(self, *args, **options):
+        kwargs = dict(
+            wait_time=settings.SQS_QUEUE_WAIT_TIME_SECONDS,
+            visibility_timeout=settings.SQS_QUEUE_VISIBILITY_TIMEOUT,
+            visibility_heartbeat=settings.SQS_QUEUE_VISIBILITY_HEARTBEAT,
+            max_number_of_messages=settings.SQS_QUEUE_MAX_NUMBER_OF_MESSAGES,
+            workers=settings.SQS_QUEUE_WORKERS,
+            prefetch_batches=settings.SQS_QUEUE_PREFETCH_BATCHES,
+            adaptive_polling=settings.SQS_QUEUE_ADAPTIVE_POLLING,
+        )
         try:
-            start(
-                settings.SQS_QUEUE_URL,
-                wait_time=settings.SQS_QUEUE_WAIT_TIME_SECONDS,
-                visibility_timeout=settings.SQS_QUEUE_VISIBILITY_TIMEOUT,
-                max_number_of_messages=settings.SQS_QUEUE_MAX_NUMBER_OF_MESSAGES,  # noqa
-            )
+            if options["processes"] > 1:
+                supervise(
+                    options["processes"], queue_url=settings.SQS_QUEUE_URL, **kwargs
+                )
+            else:
+                start(settings.SQS_QUEUE_URL, **kwargs)
         except KeyboardInterrupt:
             print("Bye bye!")
@@ -53,6 +53,15 @@ class Command(BaseCommand):
         )
         parser.add_argument("--collection-id", default="record", help="")
         parser.add_argument("--chunk-size", default=10000, help="")
+        parser.add_argument(
+            "--copy",
+            default=False,
+            action="store_true",
+            help=(
+                "Load every chunk with COPY, through a staging table, instead "
+                "of multi-row INSERTs. Much faster for big databases."
+            ),
+        )
 
     def handle(self, *args, **options):
         # verbose = options["verbosity"] > 1
@@ -105,6 +114,8 @@ class Command(BaseCommand):
                 skip_validation=skip_validation,
                 skip_invalid=skip_invalid,
                 metadata={"kinto-migration": True},
+                chunk_size=int(options["chunk_size"]) if options["copy"] else 1000,
+                copy=options["copy"],
             )
             t1 = time.time()
             done += count
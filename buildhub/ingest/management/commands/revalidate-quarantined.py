@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from jsonschema import ValidationError
+
+from buildhub.ingest.s3 import ObjectTooLarge, fetch_json_and_etag, is_not_found
+from buildhub.ingest.sqs import chunked, get_rows, get_s3_client
+from buildhub.main.models import Build, QuarantinedBuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Validate every quarantined buildhub.json again and insert the ones "
+        "that are now valid. Useful after a change to the schema.yaml."
+    )
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--refetch",
+            action="store_true",
+            default=False,
+            help=(
+                "Download the S3 objects again instead of using the copy "
+                "that was stored when it was quarantined."
+            ),
+        )
+        parser.add_argument("--region", default=None, help="S3 region name")
+        parser.add_argument("--chunk-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        config = {"region_name": options["region"]}
+        ids = QuarantinedBuild.objects.order_by("id").values_list("id", flat=True)
+        valid = invalid = gone = too_large = inserted = 0
+        for chunk in chunked(ids, options["chunk_size"]):
+            rows = []
+            revalidated = []
+            for quarantined in QuarantinedBuild.objects.filter(id__in=chunk):
+                build = quarantined.build
+                etag = quarantined.s3_object_etag
+                error = None
+                if options["refetch"]:
+                    bucket_name = quarantined.s3_bucket_name
+                    try:
+                        build, etag = fetch_json_and_etag(
+                            get_s3_client(config, bucket_name),
+                            bucket_name,
+                            quarantined.s3_object_key,
+                            max_size=settings.S3_MAX_OBJECT_SIZE,
+                        )
+                    except ClientError as exception:
+                        if not is_not_found(exception):
+                            raise
+                        # Nothing to keep it around for.
+                        quarantined.delete()
+                        gone += 1
+                        continue
+                    except ObjectTooLarge as exception:
+                        # Left as it is.
+                        self.stderr.write(f"Not downloading {exception}")
+                        too_large += 1
+                        continue
+                    except ValueError as exception:
+                        build = None
+                        error = f"Not valid JSON: {exception}"
+
+                if build is not None:
+                    try:
+                        Build.validate_build(build)
+                    except ValidationError as exception:
+                        error = exception.message
+                    else:
+                        rows.extend(
+                            # The S3 object might have changed since it was
+                            # quarantined.
+                            get_rows(build, quarantined.s3_object_key, etag)
+                        )
+                        revalidated.append(quarantined.id)
+                        continue
+
+                invalid += 1
+                if error and etag != quarantined.s3_object_etag:
+                    # It's a new version of the S3 object, which the daemon
+                    # might have quarantined already.
+                    QuarantinedBuild.objects.update_or_create(
+                        s3_object_key=quarantined.s3_object_key,
+                        s3_object_etag=etag,
+                        defaults={
+                            "s3_bucket_name": quarantined.s3_bucket_name,
+                            "build": build,
+                            "error": error,
+                        },
+                    )
+                    quarantined.delete()
+                elif error and (error, build) != (quarantined.error, quarantined.build):
+                    quarantined.error = error
+                    quarantined.build = build
+                    quarantined.save()
+
+            if revalidated:
+                with transaction.atomic():
+                    inserted += len(Build.insert_many(rows))
+                    QuarantinedBuild.objects.filter(id__in=revalidated).delete()
+                valid += len(revalidated)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{valid:,} now valid ({inserted:,} builds inserted), "
+                f"{invalid:,} still invalid, "
+                f"{gone:,} no longer in S3, "
+                f"{too_large:,} too large to download."
+            )
+        )
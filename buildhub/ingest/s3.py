@@ -0,0 +1,260 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import random
+import threading
+import time
+
+import markus
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from botocore.exceptions import HTTPClientError
+
+logger = logging.getLogger("buildhub")
+metrics = markus.get_metrics("buildhub2")
+
+# The error codes S3 uses to say "slow down".
+THROTTLE_ERROR_CODES = (
+    "SlowDown",
+    "503",
+    "ServiceUnavailable",
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+)
+
+# The error codes that are worth trying again, without slowing down.
+TRANSIENT_ERROR_CODES = ("500", "InternalError", "RequestTimeout")
+
+
+class ObjectTooLarge(Exception):
+    """When an S3 object is bigger than we're willing to download."""
+
+
+def fetch_json(s3_client, bucket_name, key_name, max_size=None):
+    """Download an S3 object and return it parsed as JSON.
+
+    The ``buildhub.json`` files are just a few KB so this is a single
+    GetObject request whose body is read into one buffer. Unlike
+    ``download_fileobj()`` it doesn't go through boto3's transfer manager
+    (and its threads) nor does it copy the bytes into a BytesIO first.
+
+    If ``max_size`` is set and the object is bigger, ObjectTooLarge is raised
+    before the body is read.
+    """
+    return fetch_json_and_etag(s3_client, bucket_name, key_name, max_size)[0]
+
+
+def fetch_json_and_etag(s3_client, bucket_name, key_name, max_size=None):
+    """Like ``fetch_json()`` but return the ETag (without the quotes) of the
+    S3 object that was downloaded too."""
+    response = s3_client.get_object(Bucket=bucket_name, Key=key_name)
+    body = response["Body"]
+    try:
+        if max_size and response.get("ContentLength", 0) > max_size:
+            raise ObjectTooLarge(
+                f"{key_name} is {response['ContentLength']} bytes "
+                f"(max is {max_size})"
+            )
+        return json.loads(body.read()), response.get("ETag", "").strip('"')
+    finally:
+        body.close()
+
+
+def is_not_found(exception):
+    """Return true if a botocore ClientError is about the S3 object not
+    existing."""
+    return exception.response["Error"]["Code"] in ("404", "NoSuchKey")
+
+
+def is_throttled(exception):
+    """Return true if a botocore ClientError is S3 asking us to slow down."""
+    error = exception.response.get("Error", {})
+    status_code = exception.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return error.get("Code") in THROTTLE_ERROR_CODES or status_code == 503
+
+
+def is_transient(exception):
+    """Return true if a botocore ClientError is worth trying again."""
+    return exception.response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES
+
+
+def client_config(**kwargs):
+    """Return the botocore Config for the S3 clients. botocore's own retries
+    are turned off because they would hide the throttling from
+    AdaptiveConcurrency, which does the retrying instead."""
+    return Config(retries={"max_attempts": 0}, **kwargs)
+
+
+class AdaptiveConcurrency:
+    """Limits how many S3 requests, of one kind, are made at the same time,
+    with AIMD (additive increase, multiplicative decrease).
+
+    Every time as many requests as the current limit have completed without
+    errors, and without the latency going up, the limit is raised by one.
+    When S3 throttles us (e.g. 'SlowDown' or a 503) the limit is halved and
+    the request is retried after an exponential backoff.
+
+    The limit can never be more than `maximum`, which should be the number of
+    threads making the requests.
+    """
+
+    # What the limit is multiplied by when throttled.
+    decrease_factor = 0.5
+    # The latency is unhealthy when its moving average is this many times the
+    # best moving average seen recently.
+    latency_tolerance = 2.0
+    # But anything faster than this (seconds) is always healthy.
+    latency_floor = 0.05
+    # How many times to try a request that is throttled or fails transiently.
+    max_attempts = 8
+    # The backoff (seconds) before the first retry. It doubles every retry.
+    backoff_base = 0.1
+    backoff_max = 20
+
+    def __init__(self, name, maximum, minimum=1, initial=None):
+        self.name = name
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        if initial is None:
+            initial = self.maximum // 4
+        self.limit = min(self.maximum, max(self.minimum, initial))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latency = None
+        self.baseline = None
+        self.window_completed = 0
+        self.window_healthy = True
+        self.decreased_at = 0
+        self.tags = [f"operation:{name}"]
+        metrics.gauge("s3_concurrency", self.limit, tags=self.tags)
+
+    def call(self, function, *args, **kwargs):
+        """Call `function` when there's room for it, and retry it if it's
+        throttled or fails transiently."""
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire()
+            t0 = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except ClientError as exception:
+                if is_throttled(exception):
+                    metrics.incr("s3_throttled", tags=self.tags)
+                    self.release(throttled=t0)
+                elif is_transient(exception):
+                    self.release(healthy=False)
+                else:
+                    # E.g. a 404, which says nothing about S3's health.
+                    self.release(latency=time.time() - t0)
+                    raise
+                if attempt >= self.max_attempts:
+                    raise
+            except (BotocoreConnectionError, HTTPClientError):
+                self.release(healthy=False)
+                if attempt >= self.max_attempts:
+                    raise
+            except Exception:
+                self.release(healthy=False)
+                raise
+            else:
+                self.release(latency=time.time() - t0)
+                return result
+            self.backoff(attempt)
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, healthy=True, throttled=None):
+        """Let the next request go. If it was throttled, `throttled` is the
+        time when the request was started."""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled is not None:
+                self.decrease(throttled)
+            else:
+                if latency is not None:
+                    self.observe(latency)
+                self.window_healthy = self.window_healthy and healthy
+                self.window_completed += 1
+                if self.window_completed >= self.limit:
+                    if self.window_healthy and self.is_latency_healthy():
+                        self.increase()
+                    self.window_completed = 0
+                    self.window_healthy = True
+            self.condition.notify_all()
+
+    def observe(self, latency):
+        if self.latency is None:
+            self.latency = self.baseline = latency
+            return
+        self.latency = 0.9 * self.latency + 0.1 * latency
+        if self.latency < self.baseline:
+            self.baseline = self.latency
+        else:
+            # Slowly forget the best latency, in case it was a fluke.
+            self.baseline += 0.01 * (self.latency - self.baseline)
+
+    def is_latency_healthy(self):
+        if self.latency is None:
+            return True
+        return self.latency <= max(
+            self.baseline * self.latency_tolerance, self.latency_floor
+        )
+
+    def increase(self):
+        if self.limit < self.maximum:
+            self.limit += 1
+            metrics.gauge("s3_concurrency", self.limit, tags=self.tags)
+
+    def decrease(self, started):
+        # Requests that were already in flight when the limit was lowered
+        # are likely to be throttled too. Only the first of those counts.
+        if started < self.decreased_at:
+            return
+        self.decreased_at = time.time()
+        limit = max(self.minimum, int(self.limit * self.decrease_factor))
+        if limit < self.limit:
+            logger.warning(
+                f"S3 is throttling {self.name} requests. "
+                f"Concurrency down from {self.limit} to {limit}."
+            )
+        self.limit = limit
+        metrics.gauge("s3_concurrency", self.limit, tags=self.tags)
+        self.window_completed = 0
+        self.window_healthy = True
+
+    def backoff(self, attempt):
+        # "Full jitter" so the threads that were throttled together don't all
+        # come back at the same time.
+        seconds = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        time.sleep(random.uniform(0, seconds))
+
+
+class AdaptiveS3Client:
+    """Wraps an S3 client so that its GetObject and ListObjectsV2 requests
+    go through AdaptiveConcurrency limiters. Everything else is passed
+    through to the S3 client as is."""
+
+    def __init__(self, s3_client, get_limiter, list_limiter=None):
+        self.s3_client = s3_client
+        self.get_limiter = get_limiter
+        self.list_limiter = list_limiter or get_limiter
+
+    def get_object(self, **kwargs):
+        return self.get_limiter.call(self.s3_client.get_object, **kwargs)
+
+    def list_objects_v2(self, **kwargs):
+        return self.list_limiter.call(self.s3_client.list_objects_v2, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
@@ -2,28 +2,57 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-import io
 import itertools
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
+import queue
 import re
+import signal
+import threading
+import time
 from urllib.parse import urlparse
 
 import boto3
 import markus
 from botocore import UNSIGNED
-from botocore.client import Config
 from botocore.exceptions import ClientError
 from jsonschema import ValidationError
 from django.conf import settings
+from django.db import close_old_connections, connections as db_connections
+from elasticsearch_dsl.connections import connections as es_connections
 
-from buildhub.main.models import Build
+from buildhub.ingest.s3 import (
+    AdaptiveConcurrency,
+    AdaptiveS3Client,
+    ObjectTooLarge,
+    client_config,
+    fetch_json,
+    is_not_found,
+)
+from buildhub.main.models import Build, QuarantinedBuild
 
 logger = logging.getLogger("buildhub")
 metrics = markus.get_metrics("buildhub2")
 
+# The default boto3 session, that `boto3.client()` uses, is not thread-safe.
+# Creating clients is therefore serialized but using them is not.
+_s3_client_lock = threading.Lock()
+
+# The maximum number of entries SQS accepts in any of its batch actions.
+SQS_MAX_BATCH_SIZE = 10
+
+# How often (seconds) each daemon reports its throughput.
+THROUGHPUT_REPORT_INTERVAL = 60
+
+# The longest long-poll SQS allows.
+SQS_MAX_WAIT_TIME_SECONDS = 20
+
 
 def start(
     queue_url,
@@ -31,20 +60,41 @@ def start(
     wait_time=10,
     visibility_timeout=5,
     max_number_of_messages=1,
+    workers=1,
+    prefetch_batches=0,
+    process_number=None,
+    visibility_heartbeat=False,
+    adaptive_polling=False,
 ):
-
     queue_name = urlparse(queue_url).path.split("/")[-1]
     if not region_name:
         region_name = re.findall(r"sqs\.(.*?)\.amazonaws\.com", queue_url)[0]
 
     logger.debug(f"Connecting to SQS queue {queue_name!r} (in {region_name!r})")
     sqs = boto3.resource("sqs", region_name=region_name)
-    queue = sqs.get_queue_by_name(QueueName=queue_name)
+    sqs_queue = sqs.get_queue_by_name(QueueName=queue_name)
 
     # This is a mutable that will be included in every callback.
     # It's intended as cheap state so that things like S3 client configuration
     # and connection can be reused without having to be bootstrapped in vain.
-    config = {"region_name": region_name}
+    config = {
+        "region_name": region_name,
+        "recently_seen": RecentlySeen(settings.SQS_RECENTLY_SEEN_CACHE_SIZE),
+        # Shared by the S3 clients of all the workers.
+        "s3_limiter": AdaptiveConcurrency("get", workers, initial=workers),
+    }
+
+    # With more than 1 worker, the messages of each received batch are
+    # processed concurrently in a pool of threads. Most of the time spent on
+    # a message is waiting for S3, PostgreSQL and Elasticsearch so threads
+    # is good enough.
+    # Note that the number of messages processed at the same time can never
+    # be more than settings.SQS_QUEUE_MAX_NUMBER_OF_MESSAGES.
+    executor = None
+    if workers > 1:
+        executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="sqs-worker"
+        )
 
     # By default, we receive 1 message per call to `queue.receive_messages()`
     # but you can change that with settings.SQS_QUEUE_MAX_NUMBER_OF_MESSAGES.
@@ -53,27 +103,511 @@ def start(
     # receive that many messages. Note how the parameter is
     # called **Max**NnumberOfMessages.
     count = 0
-    # Use `itertools.count()` instead of `while True` to be able to mock it in
-    # tests.
-    for loops in itertools.count():
-        for message in queue.receive_messages(
-            WaitTimeSeconds=wait_time,
-            VisibilityTimeout=visibility_timeout,
-            MaxNumberOfMessages=max_number_of_messages,
+    # When run as one of many processes (see `supervise()`) the throughput
+    # is tagged with the process number.
+    tags = []
+    if process_number is not None:
+        tags.append(f"process:{process_number}")
+    throughput_t0 = time.time()
+    throughput_count = 0
+    heartbeat = None
+    if visibility_heartbeat:
+        # Keep extending the visibility timeout of messages we've received
+        # until we're done with them. That way the visibility timeout can be
+        # short, for fast failover if a daemon dies, without slow messages
+        # being redelivered and processed twice.
+        heartbeat = VisibilityHeartbeat(sqs_queue, visibility_timeout)
+        heartbeat.start()
+    polling = None
+    if adaptive_polling:
+        # Instead of always polling the same way, poll for as many messages
+        # as possible when there's a backlog and long-poll, less often, when
+        # the queue is idle.
+        polling = AdaptivePolling(sqs_queue, wait_time, max_number_of_messages)
+    receiving_queue = sqs_queue
+    if prefetch_batches:
+        # Boto3 resources are not thread-safe, and the messages are deleted
+        # (in this thread) whilst the next batch is being received (in the
+        # prefetch thread), so that thread gets a queue resource of its own.
+        # And a session of its own since the default session isn't
+        # thread-safe either.
+        receiving_queue = (
+            boto3.session.Session()
+            .resource("sqs", region_name=region_name)
+            .Queue(sqs_queue.url)
+        )
+    batches = receive_batches(
+        receiving_queue,
+        heartbeat=heartbeat,
+        polling=polling,
+        WaitTimeSeconds=wait_time,
+        VisibilityTimeout=visibility_timeout,
+        MaxNumberOfMessages=max_number_of_messages,
+    )
+    if prefetch_batches:
+        # Receive the next batch(es) in a background thread whilst the
+        # current batch is being processed. That way the long-poll wait time
+        # doesn't add on top of the processing time.
+        # It's bounded because the visibility timeout of a received message
+        # starts ticking the moment it's received, not when it's processed.
+        batches = prefetch(batches, prefetch_batches)
+    try:
+        for loops, messages in enumerate(batches):
+            processed = []
+            # All builds found in this batch of messages are inserted together,
+            # with a single statement, and only then are the messages deleted.
+            pending = []
+            try:
+                for message in process_messages(
+                    config, messages, pending, executor=executor
+                ):
+                    processed.append(message)
+                    count += 1
+                    logger.debug(f"Processed event number {count} (loops={loops + 1})")
+            finally:
+                # Even if one message failed, insert and acknowledge the ones
+                # that didn't.
+                if pending:
+                    insert_rows(pending)
+                    for row in pending:
+                        config["recently_seen"].add(
+                            (row["s3_object_key"], row["s3_object_etag"])
+                        )
+                if processed:
+                    delete_messages(sqs_queue, processed)
+                    # If SQS redelivers any of these, don't bother.
+                    for message in processed:
+                        config["recently_seen"].add(message.message_id)
+                if heartbeat:
+                    heartbeat.discard(messages)
+
+            elapsed = time.time() - throughput_t0
+            if elapsed >= THROUGHPUT_REPORT_INTERVAL:
+                metrics.gauge(
+                    "sqs_messages_per_second",
+                    (count - throughput_count) / elapsed,
+                    tags=tags,
+                )
+                throughput_t0 = time.time()
+                throughput_count = count
+    finally:
+        if heartbeat:
+            heartbeat.stop()
+        if executor:
+            executor.shutdown()
+
+
+class RecentlySeen:
+    """Thread-safe, bounded, set of things we have recently seen. When full,
+    the least recently seen things are forgotten first."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, item):
+        with self._lock:
+            if item in self._items:
+                self._items.move_to_end(item)
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        with self._lock:
+            self._items[item] = True
+            self._items.move_to_end(item)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class VisibilityHeartbeat:
+    """Background thread that, every so often, extends the visibility timeout
+    of all messages that are still being worked on."""
+
+    def __init__(self, sqs_queue, visibility_timeout, interval=None):
+        self.sqs_queue = sqs_queue
+        self.visibility_timeout = visibility_timeout
+        # Extend well before the current visibility timeout runs out.
+        self.interval = interval or max(visibility_timeout / 2, 1)
+        self._messages = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="sqs-heartbeat", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def add(self, messages):
+        with self._lock:
+            for message in messages:
+                self._messages[message.receipt_handle] = message
+
+    def discard(self, messages):
+        with self._lock:
+            for message in messages:
+                self._messages.pop(message.receipt_handle, None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                # Never let the thread die. The worst thing that can happen
+                # is that a message is processed twice.
+                logger.exception("Failed to extend the visibility timeout")
+
+    def beat(self):
+        with self._lock:
+            messages = list(self._messages.values())
+        # Note! Boto3 resources are not thread-safe but clients are.
+        client = self.sqs_queue.meta.client
+        for chunk in chunked(messages, SQS_MAX_BATCH_SIZE):
+            response = client.change_message_visibility_batch(
+                QueueUrl=self.sqs_queue.url,
+                Entries=[
+                    {
+                        "Id": str(i),
+                        "ReceiptHandle": message.receipt_handle,
+                        "VisibilityTimeout": self.visibility_timeout,
+                    }
+                    for i, message in enumerate(chunk)
+                ],
+            )
+            metrics.incr("sqs_visibility_extended", len(chunk))
+            for failure in response.get("Failed", []):
+                # Most likely the message has been deleted since.
+                message = chunk[int(failure["Id"])]
+                logger.debug(
+                    f"Failed to extend visibility of {message.message_id} "
+                    f"({failure.get('Code')})"
+                )
+
+
+def supervise(processes, **kwargs):
+    """Run `start()` in a number of forked processes and restart any of them
+    that exits. This way the daemon can use more than one CPU core.
+
+    The keyword arguments are passed to `start()`.
+
+    On SIGTERM (what `docker stop` sends) or SIGINT the children are
+    terminated, and waited for, before it exits.
+    """
+    context = multiprocessing.get_context("fork")
+    children = {}
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+    def spawn(number):
+        # Never let a database connection be shared across a fork. The child
+        # will open its own when it needs one.
+        db_connections.close_all()
+        process = context.Process(
+            target=_start_child,
+            args=(number,),
+            kwargs=kwargs,
+            name=f"sqs-daemon-{number}",
+        )
+        process.start()
+        logger.info(f"Started daemon process {number} (pid {process.pid})")
+        children[number] = process
+
+    for number in range(processes):
+        spawn(number)
+    try:
+        # Use `itertools.count()` instead of `while True` to be able to mock it
+        # in tests.
+        for _ in itertools.count():
+            multiprocessing.connection.wait(
+                [process.sentinel for process in children.values()]
+            )
+            for number, process in list(children.items()):
+                if process.is_alive():
+                    continue
+                logger.warning(
+                    f"Daemon process {number} (pid {process.pid}) exited "
+                    f"with {process.exitcode}. Restarting."
+                )
+                metrics.incr("sqs_daemon_restarts", tags=[f"process:{number}"])
+                # Don't spin if it keeps crashing right away.
+                time.sleep(1)
+                spawn(number)
+    finally:
+        # Don't let another SIGTERM interrupt the waiting for the children.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in children.values():
+            if process.is_alive():
+                process.terminate()
+        for process in children.values():
+            process.join()
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+
+
+def _exit_on_sigterm(signum, frame):
+    # By default, SIGTERM kills the process without any `finally` (or
+    # `atexit`) getting to run. Raising SystemExit, like Ctrl-C raises
+    # KeyboardInterrupt, means they do.
+    raise SystemExit(0)
+
+
+def _start_child(number, **kwargs):
+    # The parent's handler is inherited across the fork. On SIGTERM, which is
+    # what the parent terminates its children with, the builds of the current
+    # batch that are done get inserted and their messages deleted, like on
+    # Ctrl-C, and the child exits.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    # Any Elasticsearch connection (pool) inherited from the parent is
+    # dropped and a new one is created the first time it's needed.
+    try:
+        es_connections.remove_connection("default")
+    except KeyError:
+        pass
+    es_connections.configure(**settings.ES_CONNECTIONS)
+    try:
+        start(process_number=number, **kwargs)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def receive_batches(sqs_queue, heartbeat=None, polling=None, **kwargs):
+    """Yield lists of messages from the queue. Forever."""
+    # Use `itertools.count()` instead of `while True` to be able to mock it
+    # in tests.
+    for _ in itertools.count():
+        if polling:
+            kwargs.update(polling.parameters())
+        messages = sqs_queue.receive_messages(**kwargs)
+        if heartbeat:
+            # Start the heartbeat as soon as they're received since they might
+            # wait in the prefetch buffer for a while.
+            heartbeat.add(messages)
+        if polling:
+            polling.observe(messages)
+        yield messages
+
+
+class AdaptivePolling:
+    """Decides the WaitTimeSeconds and MaxNumberOfMessages to receive messages
+    with, based on how many messages are waiting in the queue.
+
+    When there's a backlog, receive as many messages per call as SQS allows.
+    Since the messages of a batch are processed concurrently (up to the
+    number of workers) that's also how the concurrency goes up. When the
+    queue is idle, receive as few as configured but long-poll for as long as
+    SQS allows, which means fewer API calls.
+
+    Note! SQS's queue attributes don't include the age of the oldest message
+    (that's only a CloudWatch metric) so that is approximated with the
+    'SentTimestamp' of the messages we receive.
+    """
+
+    # How often (seconds) to ask SQS for the queue attributes.
+    sample_interval = 30
+    # If there are this many messages waiting, it's a backlog.
+    backlog_threshold = SQS_MAX_BATCH_SIZE
+    # If the oldest message received is this old (seconds), it's a backlog.
+    backlog_age = 60
+
+    def __init__(self, sqs_queue, wait_time, max_number_of_messages):
+        self.sqs_queue = sqs_queue
+        self.min_wait_time = wait_time
+        self.min_number_of_messages = max_number_of_messages
+        self.depth = 0
+        self.oldest_age = 0
+        self.last_sample = None
+
+    def parameters(self):
+        if self.last_sample is None or (
+            time.time() - self.last_sample >= self.sample_interval
         ):
-            logger.debug(f"About to process message number {count}")
-            metrics.incr("sqs_messages")
-            # That last little extra whitespace is due to a bug in
-            # python-dockerflow's JSON logging handler.
-            # See https://github.com/mozilla-services/python-dockerflow/issues/29
-            logger.debug(f"Incoming SQS message body: {message.body} ")
-            process_event(config, json.loads(message.body))
-            count += 1
-            message.delete()
-            logger.debug(f"Processed event number {count} (loops={loops + 1})")
-
-
-def process_event(config, body):
+            self.sample()
+        if self.depth >= self.backlog_threshold or self.oldest_age >= self.backlog_age:
+            # Don't wait for more messages. There are plenty.
+            wait_time = 0
+            max_number_of_messages = SQS_MAX_BATCH_SIZE
+        elif self.depth:
+            wait_time = self.min_wait_time
+            max_number_of_messages = max(
+                self.min_number_of_messages,
+                min(self.depth, SQS_MAX_BATCH_SIZE),
+            )
+        else:
+            wait_time = SQS_MAX_WAIT_TIME_SECONDS
+            max_number_of_messages = self.min_number_of_messages
+        metrics.gauge("sqs_poll_wait_time", wait_time)
+        metrics.gauge("sqs_poll_max_number_of_messages", max_number_of_messages)
+        return {
+            "WaitTimeSeconds": wait_time,
+            "MaxNumberOfMessages": max_number_of_messages,
+            "AttributeNames": ["SentTimestamp"],
+        }
+
+    def sample(self):
+        self.last_sample = time.time()
+        # Note! Boto3 resources are not thread-safe but clients are.
+        response = self.sqs_queue.meta.client.get_queue_attributes(
+            QueueUrl=self.sqs_queue.url,
+            AttributeNames=["ApproximateNumberOfMessages"],
+        )
+        self.depth = int(response["Attributes"]["ApproximateNumberOfMessages"])
+        metrics.gauge("sqs_queue_depth", self.depth)
+
+    def observe(self, messages):
+        now = time.time()
+        ages = [
+            now - int(message.attributes["SentTimestamp"]) / 1000
+            for message in messages
+            if message.attributes and "SentTimestamp" in message.attributes
+        ]
+        self.oldest_age = max(ages) if ages else 0
+        metrics.gauge("sqs_oldest_message_age", self.oldest_age)
+
+
+def prefetch(iterable, size):
+    """Consume the iterable in a background thread and yield its items from
+    a buffer that never holds more than 'size' items. If the iterable raises
+    an exception, it's re-raised in the consuming thread.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Don't block forever in case the consumer has gone away.
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as exception:
+            put((None, exception))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, name="sqs-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exception = buffer.get()
+            if exception:
+                raise exception
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+
+
+def process_messages(config, messages, pending, executor=None):
+    """Process a batch of received SQS messages and yield each message once
+    it has been successfully processed. The builds to insert are appended
+    to the 'pending' list. The caller is then responsible for inserting those
+    and, after that, deleting the messages from the queue.
+
+    If an executor is passed, all messages are processed concurrently in it.
+    If any message fails, the ones that did succeed are still yielded before
+    the first exception is re-raised.
+    """
+    if executor is None:
+        for message in messages:
+            process_message(config, message, pending=pending)
+            yield message
+        return
+
+    futures = [
+        (message, executor.submit(_process_message_in_worker, config, message, pending))
+        for message in messages
+    ]
+    exception = None
+    for message, future in futures:
+        try:
+            future.result()
+        except Exception as exc:
+            logger.warning(f"Failed to process message {message.message_id}: {exc!r}")
+            exception = exception or exc
+        else:
+            yield message
+    if exception:
+        raise exception
+
+
+def delete_messages(sqs_queue, messages, attempts=3):
+    """Delete successfully processed messages from the queue with as few
+    DeleteMessageBatch calls as possible. Each call can take up to 10 messages.
+
+    Entries that SQS reports as failed are retried, unless the failure is the
+    sender's fault (e.g. an expired receipt handle) since retrying those won't
+    help. A message we failed to delete is not the end of the world. It just
+    becomes visible again after the visibility timeout and, because inserts
+    are idempotent, gets processed again in vain.
+    """
+    pending = list(messages)
+    for _ in range(attempts):
+        failed = []
+        for chunk in chunked(pending, SQS_MAX_BATCH_SIZE):
+            response = sqs_queue.delete_messages(
+                Entries=[
+                    {"Id": str(j), "ReceiptHandle": message.receipt_handle}
+                    for j, message in enumerate(chunk)
+                ]
+            )
+            metrics.incr("sqs_delete_batches")
+            for failure in response.get("Failed", []):
+                message = chunk[int(failure["Id"])]
+                logger.warning(
+                    f"Failed to delete message {message.message_id} "
+                    f"({failure.get('Code')}: {failure.get('Message')})"
+                )
+                if not failure.get("SenderFault"):
+                    failed.append(message)
+        if not failed:
+            return
+        pending = failed
+    metrics.incr("sqs_delete_failed", len(pending))
+    logger.error(f"Gave up deleting {len(pending)} messages after {attempts} attempts")
+
+
+def process_message(config, message, pending=None):
+    metrics.incr("sqs_messages")
+    recently_seen = config.get("recently_seen")
+    if recently_seen is not None and message.message_id in recently_seen:
+        metrics.incr("sqs_duplicate_message")
+        logger.debug(f"Message {message.message_id} has already been processed")
+        return
+    # That last little extra whitespace is due to a bug in
+    # python-dockerflow's JSON logging handler.
+    # See https://github.com/mozilla-services/python-dockerflow/issues/29
+    logger.debug(f"Incoming SQS message body: {message.body} ")
+    process_event(config, json.loads(message.body), pending=pending)
+
+
+def _process_message_in_worker(config, message, pending):
+    # Each worker thread gets its own database connection. Treat each message
+    # like Django treats a request and make sure that connection is usable.
+    close_old_connections()
+    try:
+        process_message(config, message, pending=pending)
+    finally:
+        close_old_connections()
+
+
+def process_event(config, body, pending=None):
     try:
         message = body["Message"]
         assert isinstance(message, str), type(message)
@@ -96,85 +630,196 @@ def process_event(config, body):
             continue
 
         metrics.incr("sqs_key_matched")
-        process_buildhub_json_key(config, s3)
+        process_buildhub_json_key(config, s3, pending=pending)
 
 
 @metrics.timer_decorator("sqs_process_buildhub_json_key")
-def process_buildhub_json_key(config, s3):
+def process_buildhub_json_key(config, s3, pending=None):
+    """Download and validate the buildhub.json S3 key. If 'pending' is a list
+    the rows to insert are appended to it, otherwise they're inserted
+    straight away."""
     logger.debug(f"S3 buildhub.json key {s3!r}")
     key_name = s3["object"]["key"]
     assert os.path.basename(key_name).endswith("buildhub.json"), key_name
     bucket_name = s3["bucket"]["name"]
-    # We need a S3 connection client to be able to download this one.
-    if bucket_name not in config:
-        logger.debug("Creating a new BOTO3 S3 CLIENT")
-        connection_config = None
-        if settings.UNSIGNED_S3_CLIENT:
-            connection_config = Config(signature_version=UNSIGNED)
-        config[bucket_name] = boto3.client(
-            "s3", config["region_name"], config=connection_config
+    if is_known_s3_object(config, key_name, s3["object"]["eTag"]):
+        # It's either an SQS redelivery or the S3 object was overwritten with
+        # the exact same content. Either way, we already have it.
+        metrics.incr("sqs_known_key_skipped")
+        logger.info(f"Did not download {key_name} because we already had it")
+        return
+    size = s3["object"].get("size")
+    if size and size > settings.S3_MAX_OBJECT_SIZE:
+        metrics.incr("sqs_too_large")
+        logger.warning(
+            f"Not downloading {key_name} (in {bucket_name}) because it's "
+            f"too large ({size} bytes)"
         )
-
-    with io.BytesIO() as f:
-        try:
-            config[bucket_name].download_fileobj(bucket_name, key_name, f)
-        except ClientError as exception:
-            if exception.response["Error"]["Code"] == "404":
-                logger.warning(
-                    f"Tried to download {key_name} (in {bucket_name}) " "but not found."
-                )
-                return
-            raise
-
-        # After it has been populated by download_fileobj() we need to
-        # rewind it so we can send it to json.load().
-        f.seek(0)
-        # Before exiting this context (and freeing up the binary data),
-        # we turn it into a Python dict.
-        build = json.load(f)
-
-    # XXX Needs to deal with how to avoid corrupt buildhub.json S3 keys
-    # never leaving the system.
-    inserted = []
+        return
+    s3_client = get_s3_client(config, bucket_name)
     try:
-        ret = Build.insert(
-            build=build,
-            s3_object_key=s3["object"]["key"],
-            s3_object_etag=s3["object"]["eTag"],
+        build = fetch_json(
+            s3_client, bucket_name, key_name, max_size=settings.S3_MAX_OBJECT_SIZE
         )
-        inserted.append(ret)
-        # This is a hack to fix https://bugzilla.mozilla.org/show_bug.cgi?id=1470948
-        # In some future world we might be able to architecture buildhub in such a way
-        # where this sort of transformation isn't buried down deep in the code
-        if (
-            build["source"]["product"] == "firefox"
-            and build["target"]["channel"] == "release"
-        ):
-            beta_build = deepcopy(build)
-            beta_build["target"]["channel"] = "beta"
-            ret = Build.insert(
-                build=beta_build,
-                s3_object_key=s3["object"]["key"],
-                s3_object_etag=s3["object"]["eTag"],
+    except ClientError as exception:
+        if is_not_found(exception):
+            logger.warning(
+                f"Tried to download {key_name} (in {bucket_name}) " "but not found."
             )
-            inserted.append(ret)
+            return
+        raise
+    except ObjectTooLarge as exception:
+        metrics.incr("sqs_too_large")
+        logger.warning(f"Not downloading {exception}")
+        return
+    except ValueError as exc:
+        # Not even valid JSON.
+        quarantine(s3, None, f"Not valid JSON: {exc}")
+        return
 
+    try:
+        Build.validate_build(build)
     except ValidationError as exc:
-        # We're only doing a try:except ValidationError: here so we get a
-        # chance to log a useful message about the S3 object and the
-        # validation error message.
-        logger.warning(
-            "Failed to insert build because the build was not valid. "
-            f"S3 key {key_name!r} (bucket {bucket_name!r}). "
-            f"Validation error message: {exc.message}"
-        )
-        raise
-    # Build.insert() above can return None (for Builds that already exist).
-    # If anything was _actually_ inserted, log it.
-    if any(inserted):
-        for i in inserted:
-            metrics.incr("sqs_inserted")
-            logger.info(f"Inserted {key_name} as a valid Build ({i.build_hash})")
+        quarantine(s3, build, exc.message)
+        return
+
+    rows = get_rows(build, s3["object"]["key"], s3["object"]["eTag"])
+    if pending is None:
+        insert_rows(rows)
     else:
-        metrics.incr("sqs_not_inserted")
-        logger.info(f"Did not insert {key_name} because we already had it")
+        # The caller will insert these, together with other rows from the same
+        # batch of messages.
+        pending.extend(rows)
+
+
+def get_rows(build, s3_object_key, s3_object_etag):
+    """Return the rows, for Build.insert_many(), that a buildhub.json
+    S3 object should become."""
+    rows = [
+        {
+            "build": build,
+            "s3_object_key": s3_object_key,
+            "s3_object_etag": s3_object_etag,
+        }
+    ]
+    for derived_build in derive_builds(build):
+        rows.append(dict(rows[0], build=derived_build))
+    return rows
+
+
+def derive_builds(build):
+    """Return the copies of the build that settings.DERIVED_BUILD_RULES says
+    should be inserted along with it."""
+    derived_builds = []
+    for rule in settings.DERIVED_BUILD_RULES:
+        if all(
+            _get_path(build, path) == value for path, value in rule["match"].items()
+        ):
+            derived_build = deepcopy(build)
+            for path, value in rule["set"].items():
+                *parents, name = path.split(".")
+                container = derived_build
+                for parent in parents:
+                    container = container.setdefault(parent, {})
+                container[name] = value
+            derived_builds.append(derived_build)
+    return derived_builds
+
+
+def _get_path(build, path):
+    value = build
+    for name in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def quarantine(s3, build, error):
+    """Put aside a buildhub.json that can't be inserted. If we didn't, its
+    message would never be deleted and it would be redelivered, and fail,
+    over and over. See the `revalidate-quarantined` command."""
+    key_name = s3["object"]["key"]
+    bucket_name = s3["bucket"]["name"]
+    logger.warning(
+        "Failed to insert build because the build was not valid. "
+        f"S3 key {key_name!r} (bucket {bucket_name!r}). "
+        f"Validation error message: {error}"
+    )
+    metrics.incr("sqs_quarantined")
+    QuarantinedBuild.objects.update_or_create(
+        s3_object_key=key_name,
+        s3_object_etag=s3["object"]["eTag"],
+        defaults={"s3_bucket_name": bucket_name, "build": build, "error": error},
+    )
+
+
+@metrics.timer_decorator("sqs_insert_rows")
+def insert_rows(rows):
+    """Insert the rows collected from processing S3 keys in one go."""
+    inserted = Build.insert_many(rows)
+    inserted_hashes = set()
+    for build in inserted:
+        metrics.incr("sqs_inserted")
+        logger.info(
+            f"Inserted {build.s3_object_key} as a valid Build ({build.build_hash})"
+        )
+        inserted_hashes.add(build.build_hash)
+    for row in rows:
+        if Build.get_build_hash(row["build"]) not in inserted_hashes:
+            metrics.incr("sqs_not_inserted")
+            logger.info(
+                f"Did not insert {row['s3_object_key']} because we already had it"
+            )
+
+
+def is_known_s3_object(config, key_name, etag):
+    """Return true if we have already inserted a build from this S3 key with
+    this ETag."""
+    recently_seen = config.get("recently_seen")
+    if recently_seen is not None and (key_name, etag) in recently_seen:
+        return True
+    # The ETags in S3 event notifications are not wrapped in double quotes but
+    # the ones we get from listing objects (in the backfill) are.
+    unquoted = etag.strip('"')
+    etags = [unquoted, f'"{unquoted}"']
+    if Build.objects.filter(s3_object_key=key_name, s3_object_etag__in=etags).exists():
+        if recently_seen is not None:
+            recently_seen.add((key_name, etag))
+        return True
+    return False
+
+
+def get_s3_client(config, bucket_name):
+    """Return an S3 client from the 'config' cache. Clients are cached per
+    bucket *and* per thread so that every worker gets its own client. Their
+    requests all go through the same AdaptiveConcurrency limiter, the
+    config's "s3_limiter", which is created if there isn't one."""
+    cache_key = (bucket_name, threading.get_ident())
+    if cache_key not in config:
+        with _s3_client_lock:
+            logger.debug("Creating a new BOTO3 S3 CLIENT")
+            if "s3_limiter" not in config:
+                # One request at a time, e.g. from a management command.
+                config["s3_limiter"] = AdaptiveConcurrency("get", 1, initial=1)
+            # No more connections than the limiter ever lets through at once.
+            pool_size = config["s3_limiter"].maximum
+            if settings.UNSIGNED_S3_CLIENT:
+                connection_config = client_config(
+                    signature_version=UNSIGNED, max_pool_connections=pool_size
+                )
+            else:
+                connection_config = client_config(max_pool_connections=pool_size)
+            config[cache_key] = AdaptiveS3Client(
+                boto3.client("s3", config["region_name"], config=connection_config),
+                config["s3_limiter"],
+            )
+    return config[cache_key]
+
+
+def chunked(sequence, size):
+    """Yield lists of at most 'size' items from the sequence."""
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        end = i + size
+        yield sequence[i:end]
@@ -69,6 +69,11 @@ def ensure_table():
 
 def insert_build(document):
     """Insert a single document into an existing BigQuery table."""
+    insert_builds([document])
+
+
+def insert_builds(documents):
+    """Insert many documents into an existing BigQuery table with one call."""
     # new client instance for every insertion
     project_id = settings.BQ_PROJECT_ID
     dataset_id = settings.BQ_DATASET_ID
@@ -76,7 +81,7 @@ def insert_build(document):
 
     client = bigquery.Client(project=project_id)
     table = client.get_table(table_id)
-    logging.info(f"Inserting rows into {table_id}")
-    errors = client.insert_rows(table, [document])
+    logging.info(f"Inserting {len(documents)} rows into {table_id}")
+    errors = client.insert_rows(table, documents)
     if errors:
         logger.error(f"failed into insert row: {errors[0]}")
@@ -54,7 +54,7 @@ class Command(BaseCommand):
         error_count = 0
         start = time.time()
 
-        builds = Build.objects.all().order_by("created_at")
+        builds = Build.objects.all()
         total_count = builds.count()
 
         # stateful inner loop
@@ -80,7 +80,7 @@ class Command(BaseCommand):
             )
 
         rows = []
-        for build in builds.iterator(chunk_size=chunk_size):
+        for build in builds.iter_months(chunk_size=chunk_size):
             valid_metadata_keys = ["commit", "version", "source", "build"]
             doc = build.to_dict()
             doc["metadata"] = {
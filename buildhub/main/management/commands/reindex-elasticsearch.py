@@ -2,11 +2,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+
 import requests
 from elasticsearch_dsl.connections import connections
 from elasticsearch.helpers import streaming_bulk
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 from buildhub.main.search import BuildDoc
 from buildhub.main.models import Build
@@ -18,10 +22,33 @@ class Command(BaseCommand):
         "In bulk. And by first deleting the index."
     )
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help=(
+                "Only reindex the builds created on or after this date "
+                "(YYYY-MM-DD). The index is then not deleted first."
+            ),
+        )
+        parser.add_argument(
+            "--until",
+            help=(
+                "Only reindex the builds created before this date "
+                "(YYYY-MM-DD). The index is then not deleted first."
+            ),
+        )
+
     def handle(self, *args, **options):
+        since = self.parse_date_option(options, "since")
+        until = self.parse_date_option(options, "until")
         build_index = BuildDoc._index
-        build_index.delete(ignore=404)
-        build_index.create()
+        if since or until:
+            # Only (re)index some months' worth of builds into the existing
+            # index.
+            build_index.create(ignore=400)
+        else:
+            build_index.delete(ignore=404)
+            build_index.create()
         es_url = settings.ES_URLS[0]
         index_name = settings.ES_BUILD_INDEX
         update_settings_url = f"{es_url}/{index_name}/_settings"
@@ -34,9 +61,9 @@ class Command(BaseCommand):
         report_every = 1000
         count = 0
 
-        qs = Build.objects.all().order_by("created_at")
+        qs = Build.objects.created_between(since, until)
         total_count = qs.count()
-        iterator = qs.iterator(chunk_size=10000)
+        iterator = qs.iter_months(chunk_size=10000)
         for success, doc in streaming_bulk(
             es,
             (m.to_search().to_dict(True) for m in iterator),
@@ -75,3 +102,12 @@ class Command(BaseCommand):
             },
         )
         response.raise_for_status()
+
+    def parse_date_option(self, options, name):
+        value = options.get(name)
+        if not value:
+            return None
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f"--{name} is not a date (YYYY-MM-DD) {value!r}")
+        return datetime.datetime.combine(date, datetime.time(tzinfo=timezone.utc))
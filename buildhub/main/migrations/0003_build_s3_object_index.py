@@ -0,0 +1,21 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Generated by Django 2.2.9 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("main", "0002_auto_20180906_1237")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="build",
+            index=models.Index(
+                fields=["s3_object_key", "s3_object_etag"], name="main_build_s3_object"
+            ),
+        )
+    ]
@@ -0,0 +1,38 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Generated by Django 2.2.9 on 2026-10-18 09:41
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("main", "0003_build_s3_object_index")]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuarantinedBuild",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("s3_bucket_name", models.CharField(max_length=400)),
+                ("s3_object_key", models.CharField(max_length=400)),
+                ("s3_object_etag", models.CharField(max_length=400)),
+                ("build", django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ("error", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("modified_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={"unique_together": {("s3_object_key", "s3_object_etag")}},
+        )
+    ]
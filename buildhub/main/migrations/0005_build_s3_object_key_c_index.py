@@ -0,0 +1,22 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import migrations
+
+# The backfill reads all the S3 keys in the same (binary) order as S3 lists
+# them. Django can't express an index with a collation so it's plain SQL.
+CREATE_INDEX = """
+CREATE INDEX main_build_s3_object_key_c
+ON main_build (s3_object_key COLLATE "C", s3_object_etag)
+WHERE s3_object_key IS NOT NULL
+"""
+
+DROP_INDEX = "DROP INDEX main_build_s3_object_key_c"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("main", "0004_quarantinedbuild")]
+
+    operations = [migrations.RunSQL(CREATE_INDEX, DROP_INDEX)]
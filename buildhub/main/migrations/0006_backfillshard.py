@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Generated by Django 2.2.9 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("main", "0005_build_s3_object_key_c_index")]
+
+    operations = [
+        migrations.CreateModel(
+            name="BackfillShard",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("s3_bucket_name", models.CharField(max_length=400)),
+                ("prefix", models.CharField(blank=True, max_length=400)),
+                ("recursive", models.BooleanField(default=True)),
+                ("last_key", models.CharField(max_length=400, null=True)),
+                ("matched_count", models.IntegerField(default=0)),
+                ("downloaded_count", models.IntegerField(default=0)),
+                ("inserted_count", models.IntegerField(default=0)),
+                ("lease_owner", models.CharField(max_length=200, null=True)),
+                ("lease_expires_at", models.DateTimeField(null=True)),
+                ("started_at", models.DateTimeField(null=True)),
+                ("finished_at", models.DateTimeField(null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("modified_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={"unique_together": {("s3_bucket_name", "prefix", "recursive")}},
+        )
+    ]
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from django.db import migrations, models, transaction
+
+# PostgreSQL 9.6 doesn't have generated columns so the copies of the build's
+# fields are kept up to date by a trigger. It runs on every insert and update,
+# whichever way it's done (ORM, raw INSERTs, COPY).
+CREATE_TRIGGER = """
+CREATE FUNCTION main_build_set_indexed_fields() RETURNS trigger AS $$
+BEGIN
+    NEW.build_id := NEW.build #>> '{build,id}';
+    NEW.source_product := NEW.build #>> '{source,product}';
+    NEW.source_revision := NEW.build #>> '{source,revision}';
+    NEW.target_channel := NEW.build #>> '{target,channel}';
+    NEW.target_platform := NEW.build #>> '{target,platform}';
+    NEW.target_version := NEW.build #>> '{target,version}';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER main_build_set_indexed_fields
+BEFORE INSERT OR UPDATE ON main_build
+FOR EACH ROW EXECUTE PROCEDURE main_build_set_indexed_fields();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER main_build_set_indexed_fields ON main_build;
+DROP FUNCTION main_build_set_indexed_fields();
+"""
+
+# Fills in the columns of the existing builds, by firing the trigger. Done
+# before the indexes are created so they're built in one go.
+FILL_IN = "UPDATE main_build SET build = build WHERE id >= %s AND id < %s"
+FILL_IN_BATCH_SIZE = 10000
+
+COLUMNS = [
+    "build_id",
+    "source_product",
+    "source_revision",
+    "target_channel",
+    "target_platform",
+    "target_version",
+]
+
+
+def fill_in(apps, schema_editor):
+    """Fill in the columns a batch of ids at a time, each batch in its own
+    transaction, so that the table isn't rewritten, and locked, all in one
+    go."""
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM main_build")
+        first, last = cursor.fetchone()
+    if first is None:
+        return
+    for start in range(first, last + 1, FILL_IN_BATCH_SIZE):
+        end = start + FILL_IN_BATCH_SIZE
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(FILL_IN, [start, end])
+
+
+def add_index(column):
+    """Create the index without locking out the writes to the table while
+    it's being built."""
+    name = f"main_build_{column}"
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                f"CREATE INDEX CONCURRENTLY {name} ON main_build ({column})",
+                f"DROP INDEX CONCURRENTLY IF EXISTS {name}",
+            )
+        ],
+        state_operations=[
+            migrations.AddIndex(
+                model_name="build", index=models.Index(fields=[column], name=name)
+            )
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction and the columns
+    # are filled in one batch (transaction) at a time.
+    atomic = False
+
+    dependencies = [("main", "0006_backfillshard")]
+
+    operations = (
+        [
+            migrations.AddField(
+                model_name="build",
+                name=column,
+                field=models.CharField(editable=False, max_length=400, null=True),
+            )
+            for column in COLUMNS
+        ]
+        + [
+            migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+            migrations.RunPython(fill_in, migrations.RunPython.noop),
+        ]
+        + [add_index(column) for column in COLUMNS]
+    )
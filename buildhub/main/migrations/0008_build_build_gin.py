@@ -0,0 +1,39 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction.
+    atomic = False
+
+    dependencies = [("main", "0007_build_indexed_fields")]
+
+    operations = [
+        # Built concurrently so that it doesn't block the writes to the
+        # table while it's being built, which, for the whole 'build', is a
+        # while.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "CREATE INDEX CONCURRENTLY main_build_build_gin "
+                    "ON main_build USING gin (build jsonb_path_ops)",
+                    "DROP INDEX CONCURRENTLY IF EXISTS main_build_build_gin",
+                )
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="build",
+                    index=django.contrib.postgres.indexes.GinIndex(
+                        fields=["build"],
+                        name="main_build_build_gin",
+                        opclasses=["jsonb_path_ops"],
+                    ),
+                )
+            ],
+        )
+    ]
@@ -0,0 +1,20 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("main", "0008_build_build_gin")]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="build",
+            index=django.contrib.postgres.indexes.BrinIndex(
+                fields=["created_at"], name="main_build_created_at_brin"
+            ),
+        )
+    ]
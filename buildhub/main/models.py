@@ -2,7 +2,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import csv
+import datetime
 import hashlib
+import io
+import itertools
 import json
 import logging
 import os
@@ -11,16 +15,19 @@ import time
 import yaml
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import BrinIndex, GinIndex
 from django.core.serializers import serialize
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Max, Min
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_bytes
 from jsonschema import ValidationError
 from jsonschema.validators import validator_for
 
-from buildhub.main.search import BuildDoc, es_retry
-from buildhub.main.bigquery import insert_build
+from buildhub.main.search import BuildDoc, es_bulk_save, es_retry
+from buildhub.main.bigquery import insert_build, insert_builds
 
 logger = logging.getLogger("buildhub")
 
@@ -31,6 +38,61 @@ _validator_class.check_schema(SCHEMA)
 validator = _validator_class(SCHEMA)
 
 
+# The most queried fields of a build, by their path in the build, and the
+# Build column each is copied into.
+INDEXED_FIELDS = {
+    "build.id": "build_id",
+    "source.product": "source_product",
+    "source.revision": "source_revision",
+    "target.channel": "target_channel",
+    "target.platform": "target_platform",
+    "target.version": "target_version",
+}
+
+
+class BuildQuerySet(models.QuerySet):
+    def filter_fields(self, **fields):
+        """Filter by fields of the build, by their path with "__" instead of
+        ".", e.g. `filter_fields(source__product="firefox")`. A list of
+        values means any of them.
+
+        The fields in INDEXED_FIELDS are looked up by their (indexed) column
+        and the rest in the JSON.
+        """
+        lookups = {}
+        for path, value in fields.items():
+            column = INDEXED_FIELDS.get(path.replace("__", "."))
+            lookup = column or f"build__{path}"
+            if isinstance(value, (list, tuple, set)):
+                lookup += "__in"
+                value = list(value)
+            lookups[lookup] = value
+        return self.filter(**lookups)
+
+    def created_between(self, since=None, until=None):
+        """Only the builds created at or after 'since' and before 'until'
+        (either is optional)."""
+        queryset = self
+        if since:
+            queryset = queryset.filter(created_at__gte=since)
+        if until:
+            queryset = queryset.filter(created_at__lt=until)
+        return queryset
+
+    def iter_months(self, chunk_size=2000):
+        """Iterate over the builds, oldest first, one calendar month (by
+        'created_at') at a time. Each month is its own query which, thanks
+        to the BRIN index on 'created_at', only reads that month's part of
+        the table."""
+        bounds = self.aggregate(first=Min("created_at"), last=Max("created_at"))
+        if bounds["first"] is None:
+            return
+        for since, until in month_ranges(bounds["first"], bounds["last"]):
+            yield from self.created_between(since, until).order_by(
+                "created_at"
+            ).iterator(chunk_size=chunk_size)
+
+
 class Build(models.Model):
     build_hash = models.CharField(max_length=45, unique=True)
     build = JSONField()
@@ -45,6 +107,45 @@ class Build(models.Model):
     s3_object_key = models.CharField(max_length=400, null=True)
     s3_object_etag = models.CharField(max_length=400, null=True)
 
+    # Copies of the INDEXED_FIELDS of the build so they can be indexed.
+    # They're set by `insert_many` and `copy_many`. A database trigger (see
+    # migration 0007) also sets them for any other insert or update.
+    build_id = models.CharField(max_length=400, null=True, editable=False)
+    source_product = models.CharField(max_length=400, null=True, editable=False)
+    source_revision = models.CharField(max_length=400, null=True, editable=False)
+    target_channel = models.CharField(max_length=400, null=True, editable=False)
+    target_platform = models.CharField(max_length=400, null=True, editable=False)
+    target_version = models.CharField(max_length=400, null=True, editable=False)
+
+    objects = BuildQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # So that "Do we already have this S3 object?" is a cheap
+            # lookup. Used by both the SQS daemon and the backfill.
+            models.Index(
+                fields=["s3_object_key", "s3_object_etag"], name="main_build_s3_object"
+            ),
+            models.Index(fields=["build_id"], name="main_build_build_id"),
+            models.Index(fields=["source_product"], name="main_build_source_product"),
+            models.Index(fields=["source_revision"], name="main_build_source_revision"),
+            models.Index(fields=["target_channel"], name="main_build_target_channel"),
+            models.Index(fields=["target_platform"], name="main_build_target_platform"),
+            models.Index(fields=["target_version"], name="main_build_target_version"),
+            # 'created_at' is set once, as a build is inserted, and new rows
+            # mostly go at the end of the table so it (roughly) follows the
+            # physical order of the rows. A BRIN index, which is tiny, lets
+            # queries by time only read the part of the table they need.
+            BrinIndex(fields=["created_at"], name="main_build_created_at_brin"),
+            # For containment queries (`build__contains`) on any of the other
+            # fields of the build.
+            GinIndex(
+                fields=["build"],
+                name="main_build_build_gin",
+                opclasses=["jsonb_path_ops"],
+            ),
+        ]
+
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.build_hash!r}>"
 
@@ -53,6 +154,9 @@ class Build(models.Model):
 
     def to_dict(self, with_timestamp=True):
         data = json.loads(serialize("json", [self]))[0]["fields"]
+        # They're just copies of what's in the build.
+        for column in INDEXED_FIELDS.values():
+            data.pop(column)
         if with_timestamp:
             data["submission_timestamp"] = time.time()
         return data
@@ -78,11 +182,57 @@ class Build(models.Model):
         metadata = metadata or {}
         if skip_validation:
             metadata["skip_validation"] = True
+        else:
+            cls.validate_build(build)
+
+        for inserted in cls.insert_many([dict(kwargs, build=build)], metadata=metadata):
+            return inserted
+
+    @classmethod
+    def insert_many(cls, rows, metadata=None, update_etag=False):
+        """Insert many builds with a single statement and return a list of the
+        builds that actually got inserted. Builds that already exist are
+        silently ignored.
+
+        Each row is a dict with a 'build' and optionally 's3_object_key' and
+        's3_object_etag'. The builds are NOT validated here. That's the
+        caller's responsibility.
+
+        If 'update_etag' is true, a build that already exists with the same
+        s3_object_key gets its s3_object_etag updated, in the same statement,
+        and is returned too. Every returned build has an 'inserted' attribute
+        to tell them apart.
+
+        Only the inserted builds are sent to Elasticsearch, with one bulk
+        request, and to BigQuery, with one insert call.
+
+        To save the round trip, the 'build' of the returned builds is the one
+        that was passed in. It's not read back from the database.
+        """
+        metadata = metadata or {}
         metadata.update(settings.VERSION)
 
-        if not skip_validation:
-            cls.validate_build(build)
-        build_hash = cls.get_build_hash(build)
+        params = []
+        builds_by_hash = {}
+        for row in rows:
+            build_hash = cls.get_build_hash(row["build"])
+            # Two equal builds in the same batch are just one build.
+            if build_hash in builds_by_hash:
+                continue
+            builds_by_hash[build_hash] = row["build"]
+            params.extend(
+                [
+                    build_hash,
+                    # Hmm... I wonder how django.contrib.postgres does this?
+                    json.dumps(row["build"]),
+                    json.dumps(metadata),
+                    row.get("s3_object_key", ""),
+                    row.get("s3_object_etag", ""),
+                ]
+                + cls.get_indexed_fields(row["build"])
+            )
+        if not builds_by_hash:
+            return []
 
         # WHY THIS COMPLICATED BEAST??
         # Short answer; because it's the only way to get a do low-level conflict
@@ -101,62 +251,246 @@ class Build(models.Model):
         #
         # ...because it has a race-condition in it that not only will happen
         # eventually, has actually been observed in production.
-        for build in Build.objects.raw(
+        indexed_columns = list(INDEXED_FIELDS.values())
+        placeholders = ", ".join(["%s"] * (5 + len(indexed_columns)))
+        values = ", ".join(
+            [f"({placeholders}, CLOCK_TIMESTAMP())"] * len(builds_by_hash)
+        )
+        on_conflict = "DO NOTHING"
+        inserted_column = "TRUE"
+        if update_etag:
+            on_conflict = """
+                DO UPDATE SET s3_object_etag = EXCLUDED.s3_object_etag
+                WHERE main_build.s3_object_key = EXCLUDED.s3_object_key
+                AND main_build.s3_object_etag IS DISTINCT FROM EXCLUDED.s3_object_etag
             """
+            # The system column 'xmax' is 0 on a row that was inserted, as
+            # opposed to updated, by this statement.
+            inserted_column = "(xmax = 0)"
+        returned_columns = cls.get_returned_columns()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
                 INSERT INTO main_build (
                     build_hash, build, metadata,
-                    s3_object_key, s3_object_etag, created_at
-                ) VALUES (
-                    %s, %s, %s, %s, %s, CLOCK_TIMESTAMP()
+                    s3_object_key, s3_object_etag,
+                    {", ".join(indexed_columns)}, created_at
+                ) VALUES {values}
+                ON CONFLICT (build_hash) {on_conflict}
+                RETURNING {", ".join(returned_columns)}, {inserted_column};
+                """,
+                params,
+            )
+            returned = cursor.fetchall()
+        builds = cls.from_returned(returned, returned_columns, builds_by_hash)
+        # If it returns something, it got created! Must inform Elasticsearch.
+        cls.send_many([build for build in builds if build.inserted])
+        return builds
+
+    @classmethod
+    def copy_many(cls, rows, metadata=None, chunk_size=10000, validate=False):
+        """Like `insert_many` but for loads that are too big for one INSERT
+        statement. Return how many builds got inserted.
+
+        Every chunk of 'chunk_size' rows is streamed, with COPY, into a
+        temporary (so unlogged and private to this connection) staging table
+        and merged into main_build with one INSERT ... SELECT. Which builds
+        already exist is then decided by a join, rather than by a huge
+        'build_hash IN (...)' list. The inserted builds are sent to
+        Elasticsearch and BigQuery one chunk at a time.
+
+        If 'validate' is true, the builds of a chunk that we don't already
+        have, found by that same join, are validated before any of them are
+        inserted. A ValidationError stops the load at that chunk. The chunks
+        before it are already inserted.
+        """
+        metadata = metadata or {}
+        metadata.update(settings.VERSION)
+        metadata_json = json.dumps(metadata)
+        rows = iter(rows)
+        inserted = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            inserted += cls.copy_chunk(chunk, metadata_json, validate=validate)
+        return inserted
+
+    @classmethod
+    def copy_chunk(cls, rows, metadata_json, validate=False):
+        buffer = io.StringIO()
+        # Quoting everything means an empty string stays an empty string.
+        # An unquoted empty value is NULL.
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        builds_by_hash = {}
+        for row in rows:
+            build_hash = cls.get_build_hash(row["build"])
+            if build_hash in builds_by_hash:
+                continue
+            builds_by_hash[build_hash] = row["build"]
+            writer.writerow(
+                [
+                    build_hash,
+                    json.dumps(row["build"]),
+                    metadata_json,
+                    row.get("s3_object_key", ""),
+                    row.get("s3_object_etag", ""),
+                ]
+                + cls.get_indexed_fields(row["build"])
+            )
+        buffer.seek(0)
+
+        indexed_columns = ", ".join(INDEXED_FIELDS.values())
+        indexed_columns_ddl = ", ".join(
+            f"{column} VARCHAR(400)" for column in INDEXED_FIELDS.values()
+        )
+        returned_columns = cls.get_returned_columns()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                CREATE TEMPORARY TABLE main_build_staging (
+                    build_hash VARCHAR(45),
+                    build JSONB,
+                    metadata JSONB,
+                    s3_object_key VARCHAR(400),
+                    s3_object_etag VARCHAR(400),
+                    {indexed_columns_ddl},
+                    ordinal SERIAL
                 )
-                ON CONFLICT (build_hash) DO NOTHING
-                RETURNING *;
+                """
+            )
+            # A missing indexed field is written as a (quoted) empty value,
+            # which FORCE_NULL turns into NULL.
+            cursor.copy_expert(
+                f"""
+                COPY main_build_staging (
+                    build_hash, build, metadata, s3_object_key, s3_object_etag,
+                    {indexed_columns}
+                ) FROM STDIN WITH (FORMAT csv, FORCE_NULL ({indexed_columns}))
                 """,
-            (
-                build_hash,
-                # Hmm... I wonder how django.contrib.postgres does this?
-                json.dumps(build),
-                json.dumps(metadata),
-                kwargs.get("s3_object_key", ""),
-                kwargs.get("s3_object_etag", ""),
-            ),
-        ):
-            # If it returns something, it got created! Must inform Elasticsearch.
-            send_to_elasticsearch(cls, build)
-            if settings.BQ_ENABLED:
-                logger.info(f"Sending {build_hash} to bigquery")
-                send_to_bigquery(cls, build)
-            else:
-                logger.info("Bigquery not enabled, not sending anything to it")
-            return build
+                buffer,
+            )
+            if validate:
+                cursor.execute(
+                    """
+                    SELECT s.build_hash FROM main_build_staging s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM main_build b WHERE b.build_hash = s.build_hash
+                    )
+                    """
+                )
+                # Raising rolls back everything, the staging table included.
+                for (build_hash,) in cursor.fetchall():
+                    cls.validate_build(builds_by_hash[build_hash])
+            cursor.execute(
+                f"""
+                INSERT INTO main_build (
+                    build_hash, build, metadata,
+                    s3_object_key, s3_object_etag, {indexed_columns}, created_at
+                )
+                SELECT
+                    build_hash, build, metadata,
+                    s3_object_key, s3_object_etag, {indexed_columns},
+                    CLOCK_TIMESTAMP()
+                FROM main_build_staging
+                ORDER BY ordinal
+                ON CONFLICT (build_hash) DO NOTHING
+                RETURNING {", ".join(returned_columns)}, TRUE;
+                """
+            )
+            returned = cursor.fetchall()
+            # Dropped straight away, rather than ON COMMIT, in case we're in
+            # an outer transaction and there's another chunk coming.
+            cursor.execute("DROP TABLE main_build_staging")
+        inserted = cls.from_returned(returned, returned_columns, builds_by_hash)
+        cls.send_many(inserted)
+        return len(inserted)
+
+    @staticmethod
+    def get_indexed_fields(build):
+        """Return the values of the INDEXED_FIELDS of the build, in order, as
+        the text they're stored as. None for any that's missing."""
+        values = []
+        for path in INDEXED_FIELDS:
+            value = build
+            for key in path.split("."):
+                value = value.get(key) if isinstance(value, dict) else None
+            if value is not None and not isinstance(value, str):
+                # Like the trigger's `#>>` would.
+                value = json.dumps(value)
+            values.append(value)
+        return values
+
+    @classmethod
+    def get_returned_columns(cls):
+        """The columns to return from an INSERT. Everything but the 'build'
+        itself, which we already have."""
+        return [
+            field.attname
+            for field in cls._meta.concrete_fields
+            if field.name != "build"
+        ]
+
+    @classmethod
+    def from_returned(cls, returned, returned_columns, builds_by_hash):
+        """Return Build instances of the rows returned by an INSERT of
+        `get_returned_columns()` plus whether the row got inserted."""
+        field_names = [field.attname for field in cls._meta.concrete_fields]
+        builds = []
+        for *columns, was_inserted in returned:
+            fields = dict(zip(returned_columns, columns))
+            fields["build"] = builds_by_hash[fields["build_hash"]]
+            build = cls.from_db(
+                connection.alias, field_names, [fields[name] for name in field_names]
+            )
+            build.inserted = was_inserted
+            builds.append(build)
+        return builds
+
+    @classmethod
+    def send_many(cls, inserted):
+        """Send the builds that just got inserted to Elasticsearch and
+        BigQuery."""
+        if not inserted:
+            return
+        send_many_to_elasticsearch(inserted)
+        if settings.BQ_ENABLED:
+            logger.info(f"Sending {len(inserted)} builds to bigquery")
+            send_many_to_bigquery(inserted)
+        else:
+            logger.info("Bigquery not enabled, not sending anything to it")
 
     @classmethod
     def bulk_insert(
-        cls, builds, metadata=None, skip_validation=False, skip_invalid=False
+        cls,
+        builds,
+        metadata=None,
+        skip_validation=False,
+        skip_invalid=False,
+        chunk_size=1000,
+        copy=False,
     ):
-        """Bulk insert that avoids potential conflict inserts by first
-        checking for existances.
+        """Insert lots of builds, with `insert_many`, 'chunk_size' builds per
+        statement. Return how many got inserted and how many were skipped
+        because they weren't valid (if 'skip_invalid').
+
+        Builds that already exist, or that are inserted by someone else at the
+        same time, are silently ignored. The inserted builds are sent to
+        Elasticsearch and BigQuery, one bulk request per chunk.
 
-        Note! This method is NOT thread-safe. The reason is that we query
-        the database which build hashes it does *not* have, then we come
-        back to this code and prepare to send them to the database with
-        Build.objects.bulk_create(). So if new builds are made during that
-        window of time, you might get conflict errors during the bulk insert.
+        If 'copy' is true, the builds are loaded with `copy_many` instead,
+        which is much faster for big loads.
 
-        Note! This method does NOT update Elasticsearch.
+        Note! Unless 'skip_invalid', nothing is inserted if any of the builds
+        we don't already have isn't valid. Except with 'copy', where the
+        builds are validated one chunk at a time.
         """
         metadata = metadata or {}
         if skip_invalid:
             assert not skip_validation
-            # Forcing this because we're doing the validation first,
-            # and it mustn't be run again.
-            skip_validation = True
         elif skip_validation:
             metadata["skip_validation"] = True
-        metadata.update(settings.VERSION)
-        # Note! Unfortunately, there is no easy way to do a bulk insert.
-        # Not until https://code.djangoproject.com/ticket/28668 lands.
-        hashes = {}
+        rows = []
         skipped = 0
         for build in builds:
             if skip_invalid:
@@ -165,25 +499,103 @@ class Build(models.Model):
                 except ValidationError:
                     skipped += 1
                     continue
-            hashes[cls.get_build_hash(build)] = build
-        for build_hash in cls.objects.filter(build_hash__in=hashes.keys()).values_list(
-            "build_hash", flat=True
-        ):
-            hashes.pop(build_hash)
-        if not skip_validation:
-            # Only run the validation on the records that we're about to
-            # insert.
-            # The reason we're doing this late is because calculating the
-            # build's hash string is much much faster than calling
-            # `cls.validate_build(build)` on the build.
-            # Did some benchmarks on this and found that it takes about
-            # 1.5ms to run the validation and 0.03ms to generate the hash.
-            for build in hashes.values():
-                cls.validate_build(build)
-        cls.objects.bulk_create(
-            [cls(build_hash=k, build=v, metadata=metadata) for k, v in hashes.items()]
-        )
-        return len(hashes), skipped
+            rows.append({"build": build})
+        validate = not skip_validation and not skip_invalid
+        if copy:
+            # Which builds we don't already have, to validate, is found by
+            # joining with the staging table. Not with a big IN (...) list.
+            return (
+                cls.copy_many(
+                    rows, metadata=metadata, chunk_size=chunk_size, validate=validate
+                ),
+                skipped,
+            )
+        if validate:
+            # Only run the validation on the builds we don't already have.
+            # Calculating the build's hash is much much faster than calling
+            # `cls.validate_build(build)` on the build. Did some benchmarks
+            # on this and found that it takes about 1.5ms to run the
+            # validation and 0.03ms to generate the hash.
+            # This is only to save time. If someone else inserts one of these
+            # builds in the meantime, `insert_many` still just ignores it.
+            rows_by_hash = {cls.get_build_hash(row["build"]): row for row in rows}
+            for build_hash in cls.objects.filter(
+                build_hash__in=rows_by_hash.keys()
+            ).values_list("build_hash", flat=True):
+                rows_by_hash.pop(build_hash)
+            rows = list(rows_by_hash.values())
+            for row in rows:
+                cls.validate_build(row["build"])
+        inserted = 0
+        for i in range(0, len(rows), chunk_size):
+            end = i + chunk_size
+            inserted += len(cls.insert_many(rows[i:end], metadata=metadata))
+        return inserted, skipped
+
+
+class QuarantinedBuild(models.Model):
+    """A buildhub.json S3 object that could not be inserted because it was
+    not valid. Kept so it can be re-validated, and inserted, later. For
+    example after a change to the schema.yaml."""
+
+    s3_bucket_name = models.CharField(max_length=400)
+    s3_object_key = models.CharField(max_length=400)
+    s3_object_etag = models.CharField(max_length=400)
+    # Null if the S3 object wasn't even valid JSON.
+    build = JSONField(null=True)
+    error = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("s3_object_key", "s3_object_etag")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.s3_object_key!r}>"
+
+
+class BackfillShard(models.Model):
+    """A part of an S3 bucket that the backfill lists on its own. Several
+    backfill processes can split the shards of a bucket between them by
+    leasing them, and each shard is resumed after its 'last_key'."""
+
+    s3_bucket_name = models.CharField(max_length=400)
+    prefix = models.CharField(max_length=400, blank=True)
+    # If false, only the keys directly in the prefix (no more "/"s after it)
+    # belong to this shard.
+    recursive = models.BooleanField(default=True)
+    last_key = models.CharField(max_length=400, null=True)
+    matched_count = models.IntegerField(default=0)
+    downloaded_count = models.IntegerField(default=0)
+    inserted_count = models.IntegerField(default=0)
+    lease_owner = models.CharField(max_length=200, null=True)
+    lease_expires_at = models.DateTimeField(null=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("s3_bucket_name", "prefix", "recursive")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.prefix!r}>"
+
+
+def month_ranges(first, last):
+    """Return the (start, end) of every calendar month, in UTC, from the
+    one 'first' is in to the one 'last' is in."""
+    first = timezone.localtime(first, timezone.utc)
+    start = datetime.datetime(first.year, first.month, 1, tzinfo=timezone.utc)
+    ranges = []
+    while start <= last:
+        if start.month == 12:
+            end = start.replace(year=start.year + 1, month=1)
+        else:
+            end = start.replace(month=start.month + 1)
+        ranges.append((start, end))
+        start = end
+    return ranges
 
 
 @receiver(post_save, sender=Build)
@@ -194,12 +606,24 @@ def send_to_elasticsearch(sender, instance, **kwargs):
 
 @receiver(post_save, sender=Build)
 def send_to_bigquery(sender, instance, **kwargs):
+    # The Python BigQuery library includes a retry mechanism for transient
+    # errors. Search https://googleapis.dev/python/bigquery/latest under
+    # google.cloud.bigquery.retry.DEFAULT_RETRY for more details.
+    insert_build(to_bigquery_document(instance))
+
+
+def send_many_to_elasticsearch(instances):
+    es_bulk_save(instance.to_search() for instance in instances)
+
+
+def send_many_to_bigquery(instances):
+    insert_builds([to_bigquery_document(instance) for instance in instances])
+
+
+def to_bigquery_document(instance):
     doc = instance.to_dict()
     valid_metadata_keys = ["commit", "version", "source", "build"]
     doc["metadata"] = {
         k: v for k, v in doc["metadata"].items() if k in valid_metadata_keys
     }
-    # The Python BigQuery library includes a retry mechanism for transient
-    # errors. Search https://googleapis.dev/python/bigquery/latest under
-    # google.cloud.bigquery.retry.DEFAULT_RETRY for more details.
-    insert_build(doc)
+    return doc
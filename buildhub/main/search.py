@@ -6,7 +6,9 @@ import logging
 
 import backoff
 from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl import Document, InnerDoc, Object, Long, Date, Keyword
+from elasticsearch_dsl.connections import connections
 from django.conf import settings
 
 
@@ -25,6 +27,13 @@ def es_retry(callable, *args, **kwargs):
     return callable(*args, **kwargs)
 
 
+def es_bulk_save(docs):
+    """Index many documents with one '_bulk' request (with retries)."""
+    actions = [doc.to_dict(include_meta=True) for doc in docs]
+    if actions:
+        es_retry(bulk, connections.get_connection(), actions)
+
+
 class _Build(InnerDoc):
     id = Keyword()
     date = Date()
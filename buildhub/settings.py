@@ -41,10 +41,42 @@ class AWS:
     # daemons that consume the queue.
     SQS_QUEUE_VISIBILITY_TIMEOUT = values.IntegerValue(5)
 
+    # If true, the visibility timeout of messages that are still being
+    # processed is extended, in the background, every half visibility timeout.
+    # So a slow message isn't redelivered to another consumer while we're
+    # still working on it.
+    SQS_QUEUE_VISIBILITY_HEARTBEAT = values.BooleanValue(True)
+
     # The maximum number of messages to return.
     # Valid values are 1 to 10. Default is 1.
     SQS_QUEUE_MAX_NUMBER_OF_MESSAGES = values.IntegerValue(1)
 
+    # Number of threads that process the messages of a received batch
+    # concurrently. 1 means every message is processed, one at a time, in
+    # the main thread.
+    # Note! This only makes sense if SQS_QUEUE_MAX_NUMBER_OF_MESSAGES is
+    # greater than 1 too.
+    SQS_QUEUE_WORKERS = values.IntegerValue(1)
+
+    # Number of received batches of messages to buffer up whilst the current
+    # batch is being processed. If set, a background thread keeps polling the
+    # queue instead of only polling once the last batch is done.
+    # Keep it small because messages sitting in the buffer are already
+    # counting down their visibility timeout. 0 means no prefetching.
+    SQS_QUEUE_PREFETCH_BATCHES = values.IntegerValue(0)
+
+    # If true, SQS_QUEUE_WAIT_TIME_SECONDS and SQS_QUEUE_MAX_NUMBER_OF_MESSAGES
+    # are only the starting point. The daemon regularly checks how many messages
+    # are waiting in the queue and, if there's a backlog, receives as many
+    # messages at a time as possible. When the queue is idle, it long-polls for
+    # as long as possible.
+    SQS_QUEUE_ADAPTIVE_POLLING = values.BooleanValue(False)
+
+    # The daemon remembers this many recently processed SQS message IDs and
+    # S3 keys (with their ETag) so that redeliveries and S3 overwrites,
+    # with the same content, can be skipped without even asking the database.
+    SQS_RECENTLY_SEEN_CACHE_SIZE = values.IntegerValue(10000)
+
     # When we ingest the SQS queue we get a payload that contains an S3 key and
     # a S3 bucket name. We then assume that we can use our boto client to connect
     # to that bucket to read the key to download its file. That S3 bucket name
@@ -56,6 +88,10 @@ class AWS:
     #  https://s3.amazonaws.com/net-mozaws-prod-delivery-firefox
     SQS_S3_BUCKET_URL = values.URLValue()
 
+    # The buildhub.json files are just a few KB. Anything bigger than this
+    # (in bytes) is not downloaded at all.
+    S3_MAX_OBJECT_SIZE = values.IntegerValue(1024 * 1024)
+
     # If we know that the S3 buckets we download from are public we should use
     # unsigned requests. The only time you'd potentially not use this is when you
     # test against an S3 bucket that is not public.
@@ -105,9 +141,34 @@ class CSP:
 
 class Backfill:
 
-    # The backfill script will write down, to disk, the last successful key
-    # (and some metadata) when it iterates though the pages.
-    RESUME_DISK_LOG_FILE = values.Value("/tmp/backfill-last-successful-key.json")
+    # A backfill process keeps the shards it's listing to itself for this
+    # many seconds at a time. If it dies, another process can take over its
+    # shards after that.
+    BACKFILL_LEASE_SECONDS = values.IntegerValue(600)
+
+    # What `manage.py backfill --since` lists, if no --prefix is given.
+    # Every '{YYYY}/{MM}' is replaced by every month since that date.
+    BACKFILL_DATED_PREFIXES = values.ListValue(
+        [
+            "pub/firefox/nightly/{YYYY}/{MM}/",
+            "pub/mobile/nightly/{YYYY}/{MM}/",
+            "pub/thunderbird/nightly/{YYYY}/{MM}/",
+        ]
+    )
+
+    # The backfill splits the S3 bucket into shards, by the prefixes this many
+    # levels of "/" deep, and lists up to that many shards concurrently.
+    # Nearly every key is under "pub/" and most of those under
+    # "pub/<product>/<channel>/", so it takes 3 levels for the shards to be
+    # anywhere near the same size.
+    BACKFILL_SHARD_DEPTH = values.IntegerValue(3)
+    BACKFILL_LISTING_WORKERS = values.IntegerValue(8)
+
+    # The most S3 objects the backfill downloads concurrently. It starts at a
+    # quarter of that and goes up, or down, depending on how S3 copes (see
+    # buildhub.ingest.s3.AdaptiveConcurrency). The inserts into the database
+    # are still done by one thread.
+    BACKFILL_DOWNLOAD_WORKERS = values.IntegerValue(32)
 
 
 class Core(Configuration, AWS, CORS, Whitenoise, CSP, Backfill):
@@ -165,6 +226,18 @@ class Core(Configuration, AWS, CORS, Whitenoise, CSP, Backfill):
         "buildhub.dockerflow_extra.check_sqs_s3_bucket_url",
     ]
 
+    # Extra builds to insert along with an ingested build. If a build matches
+    # all the "match" fields (dotted paths into the build) a copy of it, with
+    # the "set" fields changed, is inserted too.
+    DERIVED_BUILD_RULES = [
+        # Firefox release builds are also beta builds.
+        # See https://bugzilla.mozilla.org/show_bug.cgi?id=1470948
+        {
+            "match": {"source.product": "firefox", "target.channel": "release"},
+            "set": {"target.channel": "beta"},
+        }
+    ]
+
 
 class Elasticsearch:
     # Name of the Elasticsearch index to put builds into
@@ -184,6 +257,12 @@ class Elasticsearch:
     # To prevent the ES search query from being too big.
     MAX_SEARCH_SIZE = values.IntegerValue(1000)
 
+    # The simplest /api/search queries (see buildhub.api.postgres) can be
+    # answered from PostgreSQL instead of Elasticsearch. "fallback" does that
+    # only when Elasticsearch is unavailable, "prefer" does it whenever it
+    # can and "off" never does.
+    SEARCH_POSTGRES = values.Value("fallback")
+
 
 class BigQuery:
     BQ_ENABLED = values.BooleanValue(False)
@@ -3,6 +3,7 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import pytest
+from elasticsearch.exceptions import ConnectionError as ElasticsearchConnectionError
 
 from django.urls import reverse
 
@@ -198,3 +199,89 @@ def test_happy_path_records(valid_build, client, elasticsearch):
     assert response.status_code == 200
     result = response.json()
     assert result["builds"]["total"] == 1
+
+
+POSTGRES_SEARCH = {
+    "query": {
+        "bool": {
+            "filter": [
+                {"term": {"source.product": "devedition"}},
+                {"terms": {"target.channel": ["aurora", "beta"]}},
+                # Not one of the indexed fields
+                {"term": {"target.locale": {"value": "ca"}}},
+                {"range": {"download.date": {"gte": "2018-05-10", "lt": "2018-06-01"}}},
+            ]
+        }
+    },
+    "size": 2,
+    "from": 1,
+}
+
+
+@pytest.mark.django_db
+def test_search_postgres_prefer(valid_build, json_poster, elasticsearch, settings):
+    for i in range(4):
+        build = valid_build()
+        build["download"]["size"] += i
+        if i == 3:
+            build["target"]["locale"] = "sv-SE"
+        Build.insert(build)
+    # The indexed columns that the terms are looked up by are set.
+    builds = Build.objects.filter_fields(
+        source__product="devedition", target__channel="aurora"
+    )
+    assert builds.count() == 4
+    elasticsearch.flush()
+    url = reverse("api:search")
+
+    settings.SEARCH_POSTGRES = "off"
+    response = json_poster(url, POSTGRES_SEARCH)
+    assert response.status_code == 200
+    expected = response.json()["hits"]
+    assert expected["total"] == 3
+
+    settings.SEARCH_POSTGRES = "prefer"
+    response = json_poster(url, POSTGRES_SEARCH)
+    assert response.status_code == 200
+    hits = response.json()["hits"]
+    assert hits["total"] == 3
+    assert len(hits["hits"]) == 2
+    # The same builds as Elasticsearch finds, shaped the same way.
+    expected_sources = {hit["_id"]: hit["_source"] for hit in expected["hits"]}
+    for hit in hits["hits"]:
+        if hit["_id"] in expected_sources:
+            assert hit["_source"] == expected_sources[hit["_id"]]
+
+    # Aggregations are for Elasticsearch only.
+    search = {"aggs": {"versions": {"terms": {"field": "target.version"}}}}
+    response = json_poster(url, search)
+    assert response.status_code == 200
+    assert response.json()["aggregations"]
+
+
+@pytest.mark.django_db
+def test_search_postgres_fallback(valid_build, json_poster, mocker, settings):
+    build = Build.insert(valid_build())
+    assert build.build_id == "20180510160705"
+    mocked_search = mocker.patch("buildhub.api.views.BuildDoc.search")
+    mocked_search().execute.side_effect = ElasticsearchConnectionError(
+        "N/A", "Connection refused", Exception("Connection refused")
+    )
+    url = reverse("api:search")
+
+    response = json_poster(url, POSTGRES_SEARCH)
+    assert response.status_code == 200
+    # There's only 1 and it's asked "from": 1.
+    assert response.json()["hits"]["total"] == 1
+    assert response.json()["hits"]["hits"] == []
+    response = json_poster(url, {"query": {"term": {"build.id": 20180510160705}}})
+    assert response.status_code == 200
+    assert response.json()["hits"]["total"] == 1
+
+    search = {"aggs": {"versions": {"terms": {"field": "target.version"}}}}
+    with pytest.raises(ElasticsearchConnectionError):
+        json_poster(url, search)
+
+    settings.SEARCH_POSTGRES = "off"
+    with pytest.raises(ElasticsearchConnectionError):
+        json_poster(url, POSTGRES_SEARCH)
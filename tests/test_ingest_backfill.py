@@ -2,21 +2,37 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+import gzip
 import io
 import json
+import time
 from unittest import mock
 
 import pytest
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
 
-from buildhub.main.models import Build
-from buildhub.ingest.backfill import backfill
+from buildhub.ingest.inventory import InventoryError, get_inventory_objs
+from buildhub.main.models import BackfillShard, Build
+from buildhub.ingest.backfill import (
+    ExistingKeys,
+    ShardedListing,
+    backfill,
+    expand_dated_prefixes,
+    get_keys_objs,
+    iter_existing_keys,
+    plan,
+)
+from utils import s3_list_objects_v2, s3_object_response
 
 
 @pytest.mark.django_db
+@pytest.mark.parametrize("download_workers", [1, 3])
 @mock.patch("buildhub.ingest.backfill.boto3")
 def test_backfill_happy_path(
-    mocked_boto3, settings, valid_build, itertools_count, mocker
+    mocked_boto3, download_workers, settings, valid_build, itertools_count, mocker
 ):
 
     # Create a ready build that is *exactly* like our mocked S3 thing is.
@@ -39,22 +55,22 @@ def test_backfill_happy_path(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
-        assert bucket_name == "buildhubses"
+    def mocked_get_object(Bucket, Key):
+        assert Bucket == "buildhubses"
         build = valid_build()
         # Just need to mess with the build a little bit so that it's
         # still valid to the schema but makes a different build_hash.
-        if key_name == "two/buildhub.json":
-            build["download"]["mimetype"] = key_name
-        elif key_name == "three/buildhub.json":
-            build["download"]["mimetype"] = key_name
-        elif key_name == "three/Firefox-99-buildhub.json":
-            build["download"]["mimetype"] = key_name
+        if Key == "two/buildhub.json":
+            build["download"]["mimetype"] = Key
+        elif Key == "three/buildhub.json":
+            build["download"]["mimetype"] = Key
+        elif Key == "three/Firefox-99-buildhub.json":
+            build["download"]["mimetype"] = Key
         else:
-            raise NotImplementedError(key_name)
-        f.write(json.dumps(build).encode("utf-8"))
+            raise NotImplementedError(Key)
+        return s3_object_response(json.dumps(build).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
 
     def mocked_list_objects(**kwargs):
         if kwargs.get("ContinuationToken"):  # you're on page 2
@@ -70,7 +86,10 @@ def test_backfill_happy_path(
             }
 
     mocked_s3_client.list_objects_v2.side_effect = mocked_list_objects
-    backfill(settings.S3_BUCKET_URL)
+    backfill(settings.S3_BUCKET_URL, download_workers=download_workers)
+    # A connection for every listing and download worker.
+    config = mocked_boto3.client.call_args[1]["config"]
+    assert config.max_pool_connections == 1 + download_workers
 
     # We had 2 before, this should have created 2 new and edited 1
     assert Build.objects.all().count() == 4
@@ -84,6 +103,357 @@ def test_backfill_happy_path(
     )
 
 
+def test_existing_keys():
+    existing = ExistingKeys(
+        [
+            ("a/buildhub.json", "e1"),
+            ("b/buildhub.json", "e2"),
+            ("b/buildhub.json", "e3"),
+            ("d/buildhub.json", "e4"),
+        ]
+    )
+    assert existing.get("a/buildhub.json") == {"e1"}
+    assert existing.get("a/buildhub.json") == {"e1"}
+    assert existing.get("b/buildhub.json") == {"e2", "e3"}
+    assert existing.get("c/buildhub.json") == set()
+    assert existing.get("d/buildhub.json") == {"e4"}
+    assert existing.get("e/buildhub.json") == set()
+
+
+@pytest.mark.django_db
+def test_existing_keys_out_of_order(valid_build):
+    Build.insert(
+        build=valid_build(), s3_object_key="a/buildhub.json", s3_object_etag="e1"
+    )
+    existing = ExistingKeys(iter_existing_keys())
+    assert existing.get("b/buildhub.json") == set()
+    # Too late for the stream, so it's looked up in the database instead.
+    assert existing.get("a/buildhub.json") == {"e1"}
+
+
+@pytest.mark.django_db
+def test_iter_existing_keys(valid_build):
+    keys = [
+        "b/buildhub.json",
+        "a/buildhub.json",
+        "B/buildhub.json",
+        "a-b/buildhub.json",
+    ]
+    for key in keys:
+        build = valid_build()
+        build["download"]["mimetype"] = key
+        Build.insert(build=build, s3_object_key=key, s3_object_etag="etag")
+    Build.insert(build=valid_build(), s3_object_key=None, s3_object_etag=None)
+    # Sorted the way S3 lists keys, which is also how Python sorts strings.
+    assert [key for key, _ in iter_existing_keys()] == sorted(keys)
+    assert [key for key, _ in iter_existing_keys("a/")] == ["a/buildhub.json"]
+
+
+SHARDED_KEYS = [
+    "buildhub.json",
+    "pub/buildhub.json",
+    "pub/firefox/1/buildhub.json",
+    "pub/firefox/1/other.txt",
+    "pub/firefox/2/buildhub.json",
+    "pub/firefox/3/buildhub.json",
+    "pub/firefox.txt",
+    "pub/thunderbird/1/buildhub.json",
+    "pub0/buildhub.json",
+    "zzz/buildhub.json",
+]
+
+
+def sharded_listing(mocker, **kwargs):
+    mocked_s3_client = mocker.MagicMock()
+    mocked_s3_client.list_objects_v2.side_effect = s3_list_objects_v2(
+        [{"Key": key, "ETag": f"etag{i}"} for i, key in enumerate(SHARDED_KEYS)]
+    )
+    return ShardedListing(
+        mocked_s3_client,
+        "buildhubses",
+        suffix="buildhub.json",
+        max_keys=2,
+        shard_depth=2,
+        **kwargs,
+    )
+
+
+@pytest.mark.django_db
+def test_sharded_listing(mocker):
+    listing = sharded_listing(mocker, workers=3)
+    keys = []
+    for shard, objs in listing:
+        keys.extend(obj["Key"] for obj in objs)
+        listing.checkpoint(shard, objs, 1, 0)
+    assert sorted(keys) == [key for key in SHARDED_KEYS if key.endswith(".json")]
+    shards = BackfillShard.objects.filter(s3_bucket_name="buildhubses")
+    assert sorted((shard.prefix, shard.recursive) for shard in shards) == [
+        ("", False),
+        ("pub/", False),
+        ("pub/firefox/", True),
+        ("pub/thunderbird/", True),
+        ("pub0/", False),
+        ("zzz/", False),
+    ]
+    for shard in shards:
+        assert shard.finished_at
+        assert not shard.lease_owner
+    assert shards.get(prefix="pub/firefox/").matched_count == 3
+    assert shards.get(prefix="pub/firefox/").downloaded_count == 2
+
+    # Everything is done.
+    assert not list(sharded_listing(mocker, resume=True))
+    # Unless we start over.
+    assert len(list(sharded_listing(mocker))) == 7
+
+
+@pytest.mark.django_db
+def test_sharded_listing_renews_without_matches(mocker, settings):
+    settings.BACKFILL_LEASE_SECONDS = 0.15
+    mocked_s3_client = mocker.MagicMock()
+    list_objects_v2 = s3_list_objects_v2(
+        [{"Key": key, "ETag": f"etag{i}"} for i, key in enumerate(SHARDED_KEYS)]
+    )
+
+    def slow_list_objects_v2(**kwargs):
+        time.sleep(0.1)
+        return list_objects_v2(**kwargs)
+
+    mocked_s3_client.list_objects_v2.side_effect = slow_list_objects_v2
+    listing = ShardedListing(
+        mocked_s3_client, "buildhubses", suffix="nothing.json", max_keys=1
+    )
+    mocker.spy(listing, "renew")
+    # Nothing matches so nothing is yielded but the leases are still renewed.
+    assert not list(listing)
+    assert listing.renew.call_count
+
+    listing = sharded_listing(mocker)
+    batches = iter(listing)
+    for _ in range(3):
+        shard, objs = next(batches)
+        listing.checkpoint(shard, objs, 0, 0)
+    assert shard.prefix == "pub/firefox/"
+    assert objs == [{"Key": "pub/firefox/1/buildhub.json", "ETag": "etag2"}]
+    # Let's pretend it crashed.
+    batches.close()
+    shard = BackfillShard.objects.get(prefix="pub/firefox/")
+    assert shard.last_key == "pub/firefox/1/buildhub.json"
+    assert not shard.finished_at
+    assert not shard.lease_owner
+
+    keys = [
+        obj["Key"] for _, objs in sharded_listing(mocker, resume=True) for obj in objs
+    ]
+    assert keys == [
+        "pub/firefox/2/buildhub.json",
+        "pub/firefox/3/buildhub.json",
+        "pub/thunderbird/1/buildhub.json",
+        "pub0/buildhub.json",
+        "zzz/buildhub.json",
+    ]
+
+
+@pytest.mark.django_db
+def test_sharded_listing_leased_shards(mocker):
+    listing = sharded_listing(mocker)
+    listing.prepare()
+    # Another backfill process is working on this one.
+    BackfillShard.objects.filter(prefix="pub/firefox/").update(
+        lease_owner="otherhost:123",
+        lease_expires_at=timezone.now() + datetime.timedelta(minutes=5),
+    )
+    # This one was leased but whoever did, seems to have died.
+    BackfillShard.objects.filter(prefix="pub/thunderbird/").update(
+        lease_owner="otherhost:456",
+        lease_expires_at=timezone.now() - datetime.timedelta(minutes=5),
+    )
+    keys = [
+        obj["Key"] for _, objs in sharded_listing(mocker, resume=True) for obj in objs
+    ]
+    assert "pub/firefox/1/buildhub.json" not in keys
+    assert "pub/thunderbird/1/buildhub.json" in keys
+    assert not BackfillShard.objects.get(prefix="pub/firefox/").finished_at
+
+
+@pytest.mark.django_db
+def test_sharded_listing_failing_shard(mocker):
+    listing = sharded_listing(mocker)
+    list_objects_v2 = listing.s3_client.list_objects_v2.side_effect
+
+    def mocked_list_objects(**kwargs):
+        if kwargs["Prefix"] == "pub/firefox/":
+            raise ValueError("oh no")
+        return list_objects_v2(**kwargs)
+
+    listing.s3_client.list_objects_v2.side_effect = mocked_list_objects
+    with pytest.raises(ValueError):
+        list(listing)
+    # The leases were released.
+    assert not BackfillShard.objects.filter(lease_owner__isnull=False).exists()
+
+
+def test_expand_dated_prefixes():
+    since = datetime.datetime(2019, 11, 15, tzinfo=timezone.utc)
+    prefixes = ["pub/firefox/nightly/{YYYY}/{MM}/", "pub/firefox/candidates/"]
+    assert expand_dated_prefixes(prefixes, since, datetime.date(2020, 2, 1)) == [
+        "pub/firefox/nightly/2019/11/",
+        "pub/firefox/nightly/2019/12/",
+        "pub/firefox/nightly/2020/01/",
+        "pub/firefox/nightly/2020/02/",
+        "pub/firefox/candidates/",
+    ]
+    with pytest.raises(ValueError):
+        expand_dated_prefixes(prefixes, None)
+
+
+@pytest.mark.django_db
+def test_sharded_listing_prefixes_since(mocker):
+    old = datetime.datetime(2019, 1, 1, tzinfo=timezone.utc)
+    new = datetime.datetime(2019, 11, 1, tzinfo=timezone.utc)
+    mocked_s3_client = mocker.MagicMock()
+    mocked_s3_client.list_objects_v2.side_effect = s3_list_objects_v2(
+        [
+            {"Key": "pub/firefox/nightly/2019/10/a/buildhub.json", "LastModified": old},
+            {"Key": "pub/firefox/nightly/2019/11/a/buildhub.json", "LastModified": old},
+            {"Key": "pub/firefox/nightly/2019/11/b/buildhub.json", "LastModified": new},
+            {
+                "Key": "pub/thunderbird/nightly/2019/11/buildhub.json",
+                "LastModified": new,
+            },
+        ]
+    )
+    listing = ShardedListing(
+        mocked_s3_client,
+        "buildhubses",
+        suffix="buildhub.json",
+        prefixes=["pub/firefox/nightly/2019/11/"],
+        since=datetime.datetime(2019, 10, 15, tzinfo=timezone.utc),
+    )
+    keys = [obj["Key"] for _, objs in listing for obj in objs]
+    assert keys == ["pub/firefox/nightly/2019/11/b/buildhub.json"]
+    assert not BackfillShard.objects.exclude(
+        prefix__startswith="pub/firefox/nightly/2019/11/"
+    ).exists()
+
+
+def test_get_keys_objs(mocker):
+    since = datetime.datetime(2019, 10, 15, tzinfo=timezone.utc)
+    mocked_s3_client = mocker.MagicMock()
+    mocked_s3_client.list_objects_v2.side_effect = s3_list_objects_v2(
+        [
+            {"Key": "a/buildhub.json", "ETag": "e1", "LastModified": since},
+            {"Key": "a/buildhub.json.bak", "ETag": "e2", "LastModified": since},
+            {"Key": "b/buildhub.json", "ETag": "e3", "LastModified": since},
+        ]
+    )
+    keys = ["b/buildhub.json", "a/buildhub.json", "c/buildhub.json"]
+    batches = list(get_keys_objs(mocked_s3_client, "buildhubses", keys, workers=2))
+    assert [[obj["ETag"] for obj in objs] for objs in batches] == [["e3", "e1"]]
+    later = since + datetime.timedelta(days=1)
+    assert not list(get_keys_objs(mocked_s3_client, "buildhubses", keys, since=later))
+
+    # Only the keys with the suffix are even looked up.
+    mocked_s3_client.list_objects_v2.reset_mock()
+    keys = ["a/buildhub.json.bak", "b/buildhub.json"]
+    batches = list(
+        get_keys_objs(mocked_s3_client, "buildhubses", keys, suffix="buildhub.json")
+    )
+    assert [[obj["ETag"] for obj in objs] for objs in batches] == [["e3"]]
+    assert mocked_s3_client.list_objects_v2.call_count == 1
+
+
+def write_inventory(directory, files, file_format="CSV"):
+    """Write an S3 Inventory manifest.json, and its gzipped CSV files, into
+    the directory and return the path to the manifest."""
+    manifest = {
+        "sourceBucket": "buildhubses",
+        "destinationBucket": "arn:aws:s3:::buildhubses-inventory",
+        "fileFormat": file_format,
+        "fileSchema": "Bucket, Key, Size, LastModifiedDate, ETag",
+        "files": [],
+    }
+    for i, rows in enumerate(files):
+        name = f"inventory-{i}.csv.gz"
+        with gzip.open(str(directory / name), "wt") as f:
+            for key, etag in rows:
+                f.write(
+                    f'"buildhubses","{key}","1234","2019-10-01T00:00:00Z","{etag}"\n'
+                )
+        manifest["files"].append({"key": f"buildhubses/config/data/{name}"})
+    path = str(directory / "manifest.json")
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+    return path
+
+
+def test_get_inventory_objs(tmpdir, mocker):
+    manifest = write_inventory(
+        tmpdir,
+        [
+            [("b/buildhub.json", "etag1"), ("b/other.txt", "etag2")],
+            [("a/Firefox%2099%2B-buildhub.json", "etag3")],
+        ],
+    )
+    batches = get_inventory_objs(mocker.MagicMock(), manifest, suffix="buildhub.json")
+    assert list(batches) == [
+        [
+            {"Key": "b/buildhub.json", "ETag": "etag1", "Size": 1234},
+            {"Key": "a/Firefox 99+-buildhub.json", "ETag": "etag3", "Size": 1234},
+        ]
+    ]
+
+    manifest = write_inventory(tmpdir, [], file_format="Parquet")
+    with pytest.raises(InventoryError):
+        list(get_inventory_objs(mocker.MagicMock(), manifest))
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    [
+        ["--keys-from", "keys.txt", "--inventory", "s3://bucket/manifest.json"],
+        ["--keys-from", "keys.txt", "--prefix", "pub/firefox/"],
+    ],
+)
+def test_backfill_keys_from_conflicts(arguments):
+    # One of them would otherwise be silently ignored.
+    with pytest.raises(CommandError):
+        call_command("backfill", *arguments)
+
+
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.backfill.boto3")
+def test_backfill_inventory(mocked_boto3, settings, valid_build, tmpdir, mocker):
+    build = valid_build()
+    build["download"]["mimetype"] = "one/buildhub.json"
+    Build.insert(
+        build=build, s3_object_key="one/buildhub.json", s3_object_etag="abc123"
+    )
+    manifest = write_inventory(
+        tmpdir,
+        [
+            [("two/buildhub.json", "def234"), ("one/buildhub.json", "abc123")],
+            [("one/Firefox.exe", "xyz987")],
+        ],
+    )
+
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        assert Bucket == "buildhubses"
+        assert Key == "two/buildhub.json"
+        build = valid_build()
+        build["download"]["mimetype"] = Key
+        return s3_object_response(json.dumps(build).encode("utf-8"))
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    backfill(settings.S3_BUCKET_URL, inventory=manifest)
+    mocked_s3_client.list_objects_v2.assert_not_called()
+    assert Build.objects.all().count() == 2
+    assert Build.objects.get(s3_object_key="two/buildhub.json", s3_object_etag="def234")
+
+
 @pytest.mark.django_db
 @mock.patch("buildhub.ingest.backfill.boto3")
 def test_call_backfill_command(
@@ -100,3 +470,50 @@ def test_call_backfill_command(
     out = io.StringIO()
     call_command("backfill", stdout=out)
     assert "Been backfilling for 0:00" in out.getvalue()
+
+
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.backfill.boto3")
+def test_backfill_plan(mocked_boto3, settings, valid_build, mocker):
+    Build.insert(
+        build=valid_build(),
+        s3_object_key="pub/firefox/1/buildhub.json",
+        s3_object_etag="etag2",
+    )
+    build = valid_build()
+    build["download"]["mimetype"] = "pub/firefox/2/buildhub.json"
+    Build.insert(
+        build=build,
+        s3_object_key="pub/firefox/2/buildhub.json",
+        s3_object_etag="somethingdifferent",
+    )
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+    mocked_s3_client.list_objects_v2.side_effect = s3_list_objects_v2(
+        [{"Key": key, "ETag": f"etag{i}"} for i, key in enumerate(SHARDED_KEYS)]
+    )
+    mocked_s3_client.get_object.side_effect = lambda Bucket, Key: s3_object_response(
+        json.dumps(valid_build()).encode("utf-8")
+    )
+
+    report = plan(settings.S3_BUCKET_URL, shard_depth=2, sample_size=2)
+    assert report["prefixes"]["pub/firefox/"] == {
+        "new": 1,
+        "changed": 1,
+        "unchanged": 1,
+    }
+    assert report["prefixes"]["zzz/"] == {"new": 1, "changed": 0, "unchanged": 0}
+    assert report["listed"] == 8
+    assert report["download_rate"] > 0
+    assert report["estimated_seconds"] >= report["listing_seconds"]
+    assert mocked_s3_client.get_object.call_count == 2
+    # Nothing is written.
+    assert Build.objects.all().count() == 2
+    assert not BackfillShard.objects.exists()
+
+    out = io.StringIO()
+    call_command("backfill", "--plan", "--shard-depth=2", stdout=out)
+    assert "pub/firefox/" in out.getvalue()
+    assert "Listed 8 keys" in out.getvalue()
+    assert "Estimated backfill time: 0:00" in out.getvalue()
+    assert Build.objects.all().count() == 2
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, you can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+from botocore.exceptions import ClientError
+
+from buildhub.ingest.s3 import AdaptiveConcurrency, AdaptiveS3Client, is_throttled
+
+
+def client_error(code, status_code=400):
+    return ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}},
+        "GetObject",
+    )
+
+
+def test_is_throttled():
+    assert is_throttled(client_error("SlowDown", 503))
+    assert is_throttled(client_error("Whatever", 503))
+    assert not is_throttled(client_error("NoSuchKey", 404))
+
+
+def test_adaptive_concurrency_increase(mocker):
+    limiter = AdaptiveConcurrency("get", 8)
+    assert limiter.limit == 2
+    # Two windows of 2 and then 3 successful requests.
+    for _ in range(5):
+        assert limiter.call(lambda: "ok") == "ok"
+    assert limiter.limit == 4
+    for _ in range(100):
+        limiter.call(lambda: "ok")
+    # Never more than the maximum.
+    assert limiter.limit == 8
+
+
+def test_adaptive_concurrency_throttled(mocker):
+    mocker.patch.object(AdaptiveConcurrency, "backoff")
+    limiter = AdaptiveConcurrency("get", 8, initial=8)
+    function = mocker.MagicMock()
+    function.side_effect = [client_error("SlowDown", 503), "ok"]
+    assert limiter.call(function, Key="a") == "ok"
+    function.assert_called_with(Key="a")
+    assert limiter.limit == 4
+    limiter.backoff.assert_called_once_with(1)
+
+    # Requests that started before the limit was lowered don't lower it again.
+    limiter.acquire()
+    limiter.release(throttled=0)
+    assert limiter.limit == 4
+
+    # It gives up eventually.
+    function.side_effect = client_error("SlowDown", 503)
+    with pytest.raises(ClientError):
+        limiter.call(function)
+    assert function.call_count == 2 + limiter.max_attempts
+    assert limiter.limit == 1
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_concurrency_not_found(mocker):
+    mocker.patch.object(AdaptiveConcurrency, "backoff")
+    limiter = AdaptiveConcurrency("get", 8, initial=4)
+    function = mocker.MagicMock()
+    function.side_effect = client_error("NoSuchKey", 404)
+    with pytest.raises(ClientError):
+        limiter.call(function)
+    # Not retried and not slowing down.
+    function.assert_called_once_with()
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_s3_client(mocker):
+    s3_client = mocker.MagicMock()
+    s3_client.get_object.return_value = {"Body": "..."}
+    get_limiter = AdaptiveConcurrency("get", 4)
+    list_limiter = AdaptiveConcurrency("list", 4)
+    mocker.spy(get_limiter, "call")
+    mocker.spy(list_limiter, "call")
+    client = AdaptiveS3Client(s3_client, get_limiter, list_limiter)
+    assert client.get_object(Bucket="b", Key="k") == {"Body": "..."}
+    s3_client.get_object.assert_called_once_with(Bucket="b", Key="k")
+    client.list_objects_v2(Bucket="b")
+    s3_client.list_objects_v2.assert_called_once_with(Bucket="b")
+    assert get_limiter.call.call_count == 1
+    assert list_limiter.call.call_count == 1
+    # Everything else goes straight to the S3 client.
+    client.head_bucket(Bucket="b")
+    s3_client.head_bucket.assert_called_once_with(Bucket="b")
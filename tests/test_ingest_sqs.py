@@ -4,15 +4,26 @@
 
 import io
 import json
+import signal
 from unittest import mock
 
 import pytest
 from botocore.exceptions import ClientError
 from django.core.management import call_command
-from jsonschema import ValidationError
 
-from buildhub.ingest.sqs import start
-from buildhub.main.models import Build
+from buildhub.ingest.s3 import AdaptiveConcurrency
+from buildhub.ingest.sqs import (
+    AdaptivePolling,
+    RecentlySeen,
+    VisibilityHeartbeat,
+    delete_messages,
+    derive_builds,
+    prefetch,
+    start,
+    supervise,
+)
+from buildhub.main.models import Build, QuarantinedBuild
+from utils import s3_object_response
 
 
 @pytest.mark.django_db
@@ -57,13 +68,13 @@ def test_start_happy_path(mocked_boto3, settings, valid_build, itertools_count,
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        f.write(json.dumps(valid_build()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        return s3_object_response(json.dumps(valid_build()).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -74,6 +85,55 @@ def test_start_happy_path(mocked_boto3, settings, valid_build, itertools_count,
     mocked_boto3.client.assert_called_with("s3", "ca-north-2", config=mock.ANY)
 
 
+@pytest.mark.django_db(transaction=True)
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_start_with_workers(
+    mocked_boto3, settings, valid_build, itertools_count, mocker
+):
+    mocked_messages = []
+    for i in range(3):
+        mocked_message = mocker.MagicMock()
+        message = {
+            "Message": json.dumps(
+                {
+                    "Records": [
+                        {
+                            "s3": {
+                                "object": {
+                                    "key": f"some/path/{i}/buildhub.json",
+                                    "eTag": f"e4eb6609382efd6b3bc9deec616ad5c{i}",
+                                },
+                                "bucket": {"name": "buildhubses"},
+                            }
+                        }
+                    ]
+                }
+            )
+        }
+        mocked_message.body = json.dumps(message)
+        mocked_messages.append(mocked_message)
+    mocked_queue = mocker.MagicMock()
+    mocked_queue.receive_messages().__iter__.return_value = mocked_messages
+    mocked_boto3.resource().get_queue_by_name.return_value = mocked_queue
+
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        assert Bucket == "buildhubses"
+        build = valid_build()
+        # Make each build unique.
+        build["download"]["mimetype"] = Key
+        return s3_object_response(json.dumps(build).encode("utf-8"))
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    start(settings.SQS_QUEUE_URL, max_number_of_messages=3, workers=2)
+    assert Build.objects.all().count() == 3
+    # All 3 messages should have been deleted in 1 batch.
+    (call,) = mocked_queue.delete_messages.call_args_list
+    assert len(call[1]["Entries"]) == 3
+
+
 @pytest.mark.django_db
 @mock.patch("buildhub.ingest.sqs.boto3")
 def test_start_happy_path_release_channel(
@@ -119,20 +179,24 @@ def test_start_happy_path_release_channel(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        f.write(json.dumps(valid_build_release_channel()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        return s3_object_response(
+            json.dumps(valid_build_release_channel()).encode("utf-8")
+        )
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
     )
     # It should have created 2 Builds
-    # TODO: verify channel on both objects
-    assert Build.objects.all().count() == 2
+    assert sorted(Build.objects.values_list("build__target__channel", flat=True)) == [
+        "beta",
+        "release",
+    ]
 
     mocked_boto3.client.assert_called_with("s3", "ca-north-2", config=mock.ANY)
 
@@ -182,13 +246,15 @@ def test_start_happy_path_fennec_release_channel(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        f.write(json.dumps(valid_build_fennec_release_channel()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        return s3_object_response(
+            json.dumps(valid_build_fennec_release_channel()).encode("utf-8")
+        )
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -242,13 +308,13 @@ def test_records_legacy_message(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        f.write(json.dumps(valid_build()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        return s3_object_response(json.dumps(valid_build()).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -287,13 +353,13 @@ def test_suffix_match(mocked_boto3, settings, valid_build, itertools_count, mock
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "firefox-99-buildhub.json"
-        f.write(json.dumps(valid_build()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "firefox-99-buildhub.json"
+        return s3_object_response(json.dumps(valid_build()).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -333,20 +399,26 @@ def test_signed_s3_bucket(mocked_boto3, settings, valid_build, itertools_count,
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "firefox-99-buildhub.json"
-        f.write(json.dumps(valid_build()).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "firefox-99-buildhub.json"
+        return s3_object_response(json.dumps(valid_build()).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
     )
     # It should have created 1 Build
     assert Build.objects.get()
-    mocked_boto3.client.assert_called_with("s3", "ca-north-2", config=None)
+    mocked_boto3.client.assert_called_with("s3", "ca-north-2", config=mock.ANY)
+    # Signed, and without botocore's retries.
+    config = mocked_boto3.client.call_args[1]["config"]
+    assert config.signature_version is None
+    assert config.retries == {"max_attempts": 0}
+    # As many connections as there are workers.
+    assert config.max_pool_connections == 1
 
 
 @pytest.mark.django_db
@@ -384,13 +456,13 @@ def test_ingest_idempotently(
     build = valid_build()
     Build.insert(build)
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        f.write(json.dumps(build).encode("utf-8"))
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        return s3_object_response(json.dumps(build).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -399,6 +471,105 @@ def test_ingest_idempotently(
     assert Build.objects.all().count() == 1
 
 
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_skip_known_s3_object(
+    mocked_boto3, settings, valid_build, itertools_count, mocker
+):
+    itertools_count.count.return_value = [0, 1]
+    mocked_message = mocker.MagicMock()
+    message = {
+        "Message": json.dumps(
+            {
+                "Records": [
+                    {
+                        "s3": {
+                            "object": {
+                                "key": "some/path/to/buildhub.json",
+                                "eTag": "e4eb6609382efd6b3bc9deec616ad5c0",
+                            },
+                            "bucket": {"name": "buildhubses"},
+                        }
+                    },
+                    {
+                        "s3": {
+                            "object": {
+                                "key": "other/path/to/buildhub.json",
+                                "eTag": "77e09ba7e37836c2cf0ce59e1e8361ab",
+                            },
+                            "bucket": {"name": "buildhubses"},
+                        }
+                    },
+                ]
+            }
+        )
+    }
+    mocked_message.body = json.dumps(message)
+    mocked_queue = mocker.MagicMock()
+    # The same message is delivered twice.
+    mocked_queue.receive_messages.side_effect = [[mocked_message], [mocked_message]]
+    mocked_boto3.resource().get_queue_by_name.return_value = mocked_queue
+
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    # Pretend the backfill had already inserted the first one.
+    Build.insert(
+        valid_build(),
+        s3_object_key="some/path/to/buildhub.json",
+        s3_object_etag='"e4eb6609382efd6b3bc9deec616ad5c0"',
+    )
+
+    downloaded = []
+
+    def mocked_get_object(Bucket, Key):
+        downloaded.append(Key)
+        build = valid_build()
+        build["download"]["mimetype"] = Key
+        return s3_object_response(json.dumps(build).encode("utf-8"))
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    start(settings.SQS_QUEUE_URL)
+    # Only the unknown one was ever downloaded, and only once.
+    assert downloaded == ["other/path/to/buildhub.json"]
+    assert Build.objects.all().count() == 2
+
+
+def test_derive_builds(settings, valid_build):
+    build = valid_build()
+    build["source"]["product"] = "devedition"
+    build["target"]["channel"] = "aurora"
+    assert derive_builds(build) == []
+
+    settings.DERIVED_BUILD_RULES = [
+        {
+            "match": {"source.product": "devedition", "target.channel": "aurora"},
+            "set": {"target.channel": "beta", "extra.derived": True},
+        },
+        {"match": {"no.such.path": "x"}, "set": {"target.channel": "nightly"}},
+    ]
+    (derived,) = derive_builds(build)
+    assert derived["target"]["channel"] == "beta"
+    assert derived["extra"] == {"derived": True}
+    assert derived["source"] == build["source"]
+    # The original is left alone
+    assert build["target"]["channel"] == "aurora"
+    assert "extra" not in build
+
+
+def test_recently_seen():
+    recently_seen = RecentlySeen(2)
+    recently_seen.add("a")
+    recently_seen.add("b")
+    assert "a" in recently_seen
+    # Now "b" is the least recently seen.
+    recently_seen.add("c")
+    assert "b" not in recently_seen
+    assert "a" in recently_seen
+    assert "c" in recently_seen
+    assert len(recently_seen) == 2
+
+
 @pytest.mark.django_db
 @mock.patch("buildhub.ingest.sqs.boto3")
 def test_start_file_not_found(
@@ -432,14 +603,14 @@ def test_start_file_not_found(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
-        parsed_response = {"Error": {"Code": "404", "Message": "Not found"}}
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
+        parsed_response = {"Error": {"Code": "NoSuchKey", "Message": "Not found"}}
         raise ClientError(parsed_response, "GetObject")
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
     start(settings.SQS_QUEUE_URL)
     mocked_boto3.resource().get_queue_by_name.assert_called_with(
         QueueName="buildhub-s3-events"
@@ -448,6 +619,60 @@ def test_start_file_not_found(
     assert not Build.objects.all().exists()
 
 
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_too_large_s3_object(
+    mocked_boto3, settings, valid_build, itertools_count, mocker
+):
+    settings.S3_MAX_OBJECT_SIZE = 1000
+    mocked_message = mocker.MagicMock()
+    message = {
+        "Message": json.dumps(
+            {
+                "Records": [
+                    {
+                        "s3": {
+                            "object": {
+                                "key": "too/big/buildhub.json",
+                                "eTag": "e4eb6609382efd6b3bc9deec616ad5c0",
+                                "size": 1001,
+                            },
+                            "bucket": {"name": "buildhubses"},
+                        }
+                    },
+                    {
+                        "s3": {
+                            "object": {
+                                # This one's event doesn't say how big it is
+                                "key": "also/too/big/buildhub.json",
+                                "eTag": "77e09ba7e37836c2cf0ce59e1e8361ab",
+                            },
+                            "bucket": {"name": "buildhubses"},
+                        }
+                    },
+                ]
+            }
+        )
+    }
+    mocked_message.body = json.dumps(message)
+    mocked_queue = mocker.MagicMock()
+    mocked_queue.receive_messages().__iter__.return_value = [mocked_message]
+    mocked_boto3.resource().get_queue_by_name.return_value = mocked_queue
+
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        assert Key == "also/too/big/buildhub.json"
+        return s3_object_response(b" " * 1001)
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    start(settings.SQS_QUEUE_URL)
+    assert not Build.objects.all().exists()
+    # It's still considered processed
+    mocked_queue.delete_messages.assert_called_once()
+
+
 @pytest.mark.django_db
 @mock.patch("buildhub.ingest.sqs.boto3")
 def test_bad_client_errors(
@@ -479,17 +704,20 @@ def test_bad_client_errors(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
         parsed_response = {"Error": {"Code": "500", "Message": "Oh no!"}}
         raise ClientError(parsed_response, "GetObject")
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    # A 500 is retried but without actually sleeping between the attempts.
+    mocker.patch.object(AdaptiveConcurrency, "backoff")
     with pytest.raises(ClientError) as exception:
         start(settings.SQS_QUEUE_URL)
     assert "An error occurred (500)" in str(exception.value)
+    assert mocked_s3_client.get_object.call_count == AdaptiveConcurrency.max_attempts
 
 
 @pytest.mark.django_db
@@ -523,19 +751,360 @@ def test_not_valid_buildhub_json(
     mocked_s3_client = mocker.MagicMock()
     mocked_boto3.client.return_value = mocked_s3_client
 
-    def mocked_download_fileobj(bucket_name, key_name, f):
+    def mocked_get_object(Bucket, Key):
         # Sanity checks that the mocking is right
-        assert bucket_name == "buildhubses"
-        assert key_name == "some/path/to/buildhub.json"
+        assert Bucket == "buildhubses"
+        assert Key == "some/path/to/buildhub.json"
         build = valid_build()
         build["source"]["junk"] = True  # will make it invalid
-        f.write(json.dumps(build).encode("utf-8"))
+        return s3_object_response(json.dumps(build).encode("utf-8"))
 
-    mocked_s3_client.download_fileobj.side_effect = mocked_download_fileobj
-    with pytest.raises(ValidationError) as exception:
-        start(settings.SQS_QUEUE_URL)
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    start(settings.SQS_QUEUE_URL)
+    assert not Build.objects.all().exists()
+    # Instead of crashing, it's put in quarantine and the message is deleted.
+    quarantined = QuarantinedBuild.objects.get()
+    assert quarantined.s3_object_key == "some/path/to/buildhub.json"
+    assert quarantined.s3_object_etag == "e4eb6609382efd6b3bc9deec616ad5c0"
+    assert quarantined.s3_bucket_name == "buildhubses"
+    assert quarantined.build["source"]["junk"]
     err_msg = "Additional properties are not allowed ('junk' was unexpected)"
-    assert err_msg in str(exception.value)
+    assert err_msg in quarantined.error
+    mocked_queue.delete_messages.assert_called_once()
+
+    # Suppose the schema changes and now that build is valid.
+    with mock.patch.object(Build, "validate_build"):
+        out = io.StringIO()
+        call_command("revalidate-quarantined", stdout=out)
+    assert "1 now valid (1 builds inserted)" in out.getvalue()
+    assert not QuarantinedBuild.objects.all().exists()
+    build = Build.objects.get()
+    assert build.s3_object_key == "some/path/to/buildhub.json"
+
+
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_revalidate_quarantined_refetch(mocked_boto3, valid_build, mocker):
+    build = valid_build()
+    build["source"]["junk"] = True
+    QuarantinedBuild.objects.create(
+        s3_bucket_name="buildhubses",
+        s3_object_key="some/path/to/buildhub.json",
+        s3_object_etag="e4eb6609382efd6b3bc9deec616ad5c0",
+        build=build,
+        error="Some old error message",
+    )
+    QuarantinedBuild.objects.create(
+        s3_bucket_name="buildhubses",
+        s3_object_key="some/path/to/huge/buildhub.json",
+        s3_object_etag="a1b2c3",
+        build=build,
+        error="Some old error message",
+    )
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        assert Bucket == "buildhubses"
+        if Key == "some/path/to/huge/buildhub.json":
+            return {"Body": io.BytesIO(b"{}"), "ContentLength": 10**9}
+        assert Key == "some/path/to/buildhub.json"
+        # It's been fixed since, and so has its ETag changed.
+        response = s3_object_response(json.dumps(valid_build()).encode("utf-8"))
+        response["ETag"] = '"f1e2d3"'
+        return response
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    out = io.StringIO()
+    err = io.StringIO()
+    call_command("revalidate-quarantined", "--refetch", stdout=out, stderr=err)
+    assert "1 now valid (1 builds inserted)" in out.getvalue()
+    assert "1 too large to download" in out.getvalue()
+    assert "huge/buildhub.json is 1000000000 bytes" in err.getvalue()
+    # The one that's too large is left as it is.
+    quarantined = QuarantinedBuild.objects.get()
+    assert quarantined.s3_object_etag == "a1b2c3"
+    assert quarantined.error == "Some old error message"
+    build = Build.objects.get()
+    assert build.build == valid_build()
+    assert build.s3_object_etag == "f1e2d3"
+
+
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_revalidate_quarantined_refetch_new_etag(mocked_boto3, valid_build, mocker):
+    build = valid_build()
+    build["source"]["junk"] = True
+    # The old version of the S3 object, and the new one that the daemon has
+    # already quarantined too.
+    for etag in ("a1b2c3", "f1e2d3"):
+        QuarantinedBuild.objects.create(
+            s3_bucket_name="buildhubses",
+            s3_object_key="some/path/to/buildhub.json",
+            s3_object_etag=etag,
+            build=build,
+            error="Some old error message",
+        )
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        response = s3_object_response(json.dumps(build).encode("utf-8"))
+        response["ETag"] = '"f1e2d3"'
+        return response
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    out = io.StringIO()
+    call_command("revalidate-quarantined", "--refetch", stdout=out)
+    assert "0 now valid (0 builds inserted), 2 still invalid" in out.getvalue()
+    # Only the new version is left.
+    quarantined = QuarantinedBuild.objects.get()
+    assert quarantined.s3_object_etag == "f1e2d3"
+    assert "'junk' was unexpected" in quarantined.error
+
+
+@pytest.mark.django_db
+def test_revalidate_quarantined_still_invalid(valid_build):
+    build = valid_build()
+    build["source"]["junk"] = True
+    QuarantinedBuild.objects.create(
+        s3_bucket_name="buildhubses",
+        s3_object_key="some/path/to/buildhub.json",
+        s3_object_etag="e4eb6609382efd6b3bc9deec616ad5c0",
+        build=build,
+        error="Some old error message",
+    )
+    out = io.StringIO()
+    call_command("revalidate-quarantined", stdout=out)
+    assert "0 now valid (0 builds inserted), 1 still invalid" in out.getvalue()
+    quarantined = QuarantinedBuild.objects.get()
+    assert "'junk' was unexpected" in quarantined.error
+    assert not Build.objects.all().exists()
+
+
+@pytest.mark.django_db
+@mock.patch("buildhub.ingest.sqs.boto3")
+def test_start_with_prefetch(
+    mocked_boto3, settings, valid_build, itertools_count, mocker
+):
+    itertools_count.count.return_value = [0, 1]
+    mocked_message = mocker.MagicMock()
+    message = {
+        "Message": json.dumps(
+            {
+                "Records": [
+                    {
+                        "s3": {
+                            "object": {
+                                "key": "some/path/to/buildhub.json",
+                                "eTag": "e4eb6609382efd6b3bc9deec616ad5c0",
+                            },
+                            "bucket": {"name": "buildhubses"},
+                        }
+                    }
+                ]
+            }
+        )
+    }
+    mocked_message.body = json.dumps(message)
+    mocked_queue = mocker.MagicMock()
+    mocked_boto3.resource().get_queue_by_name.return_value = mocked_queue
+    # The prefetch thread receives through a queue resource of its own.
+    mocked_prefetch_queue = mocker.MagicMock()
+    mocked_prefetch_queue.receive_messages.side_effect = [[mocked_message], []]
+    mocked_session = mocked_boto3.session.Session()
+    mocked_session.resource().Queue.return_value = mocked_prefetch_queue
+
+    mocked_s3_client = mocker.MagicMock()
+    mocked_boto3.client.return_value = mocked_s3_client
+
+    def mocked_get_object(Bucket, Key):
+        return s3_object_response(json.dumps(valid_build()).encode("utf-8"))
+
+    mocked_s3_client.get_object.side_effect = mocked_get_object
+    start(settings.SQS_QUEUE_URL, prefetch_batches=1, visibility_heartbeat=True)
+    assert Build.objects.get()
+    assert mocked_prefetch_queue.receive_messages.call_count == 2
+    mocked_session.resource().Queue.assert_called_with(mocked_queue.url)
+    assert not mocked_queue.receive_messages.called
+    mocked_queue.delete_messages.assert_called_once()
+
+
+def test_prefetch():
+    assert list(prefetch(range(5), 2)) == [0, 1, 2, 3, 4]
+
+    def failing():
+        yield 1
+        raise ValueError("oh no")
+
+    iterator = prefetch(failing(), 1)
+    assert next(iterator) == 1
+    with pytest.raises(ValueError):
+        next(iterator)
+
+
+@mock.patch("buildhub.ingest.sqs.time")
+@mock.patch("buildhub.ingest.sqs.multiprocessing")
+def test_supervise_restarts_children(
+    mocked_multiprocessing, mocked_time, itertools_count, mocker
+):
+    started = []
+
+    def make_process(target, args, kwargs, name):
+        process = mocker.MagicMock()
+        process.name = name
+        # The first child "crashes" and the second one doesn't.
+        process.is_alive.return_value = len(started) != 0
+        process.exitcode = 1
+        started.append(process)
+        return process
+
+    mocked_multiprocessing.get_context().Process.side_effect = make_process
+    supervise(2, queue_url="https://sqs.ca-north-2.amazonaws.com/123/queue")
+    assert [p.name for p in started] == [
+        "sqs-daemon-0",
+        "sqs-daemon-1",
+        "sqs-daemon-0",
+    ]
+    for process in started:
+        process.start.assert_called_once_with()
+    crashed, second, restarted = started
+    # When the supervisor exits, it waits for its current children.
+    second.join.assert_called_once_with()
+    restarted.join.assert_called_once_with()
+
+
+@mock.patch("buildhub.ingest.sqs.multiprocessing")
+def test_supervise_sigterm(mocked_multiprocessing, mocker):
+    started = []
+
+    def make_process(target, args, kwargs, name):
+        process = mocker.MagicMock()
+        process.is_alive.return_value = True
+        started.append(process)
+        return process
+
+    def wait(sentinels):
+        # As if `docker stop` sent a SIGTERM whilst waiting for the children.
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+
+    mocked_multiprocessing.get_context().Process.side_effect = make_process
+    mocked_multiprocessing.connection.wait.side_effect = wait
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    with pytest.raises(SystemExit):
+        supervise(2, queue_url="https://sqs.ca-north-2.amazonaws.com/123/queue")
+    assert len(started) == 2
+    for process in started:
+        process.terminate.assert_called_once_with()
+        process.join.assert_called_once_with()
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_visibility_heartbeat(mocker):
+    mocked_queue = mocker.MagicMock()
+    mocked_queue.url = "https://sqs.ca-north-2.amazonaws.com/123/queue"
+    mocked_client = mocked_queue.meta.client
+    mocked_messages = []
+    for i in range(3):
+        mocked_message = mocker.MagicMock()
+        mocked_message.receipt_handle = f"handle{i}"
+        mocked_messages.append(mocked_message)
+
+    heartbeat = VisibilityHeartbeat(mocked_queue, 30)
+    assert heartbeat.interval == 15
+    heartbeat.add(mocked_messages)
+    heartbeat.discard(mocked_messages[:1])
+    heartbeat.beat()
+    mocked_client.change_message_visibility_batch.assert_called_once_with(
+        QueueUrl=mocked_queue.url,
+        Entries=[
+            {"Id": "0", "ReceiptHandle": "handle1", "VisibilityTimeout": 30},
+            {"Id": "1", "ReceiptHandle": "handle2", "VisibilityTimeout": 30},
+        ],
+    )
+
+    # When there's nothing in flight, there's nothing to do.
+    mocked_client.reset_mock()
+    heartbeat.discard(mocked_messages)
+    heartbeat.beat()
+    mocked_client.change_message_visibility_batch.assert_not_called()
+
+
+@mock.patch("buildhub.ingest.sqs.time")
+def test_adaptive_polling(mocked_time, mocker):
+    mocked_time.time.return_value = 1000.0
+    mocked_queue = mocker.MagicMock()
+    mocked_queue.url = "https://sqs.ca-north-2.amazonaws.com/123/queue"
+    mocked_client = mocked_queue.meta.client
+
+    def queue_depth(depth):
+        mocked_client.get_queue_attributes.return_value = {
+            "Attributes": {"ApproximateNumberOfMessages": str(depth)}
+        }
+
+    polling = AdaptivePolling(mocked_queue, 10, 1)
+    # Idle queue
+    queue_depth(0)
+    parameters = polling.parameters()
+    assert parameters["WaitTimeSeconds"] == 20
+    assert parameters["MaxNumberOfMessages"] == 1
+    mocked_client.get_queue_attributes.assert_called_once_with(
+        QueueUrl=mocked_queue.url, AttributeNames=["ApproximateNumberOfMessages"]
+    )
+
+    # The queue isn't sampled again until the interval has passed.
+    queue_depth(1000)
+    assert polling.parameters()["WaitTimeSeconds"] == 20
+    mocked_time.time.return_value += polling.sample_interval
+    parameters = polling.parameters()
+    assert parameters["WaitTimeSeconds"] == 0
+    assert parameters["MaxNumberOfMessages"] == 10
+
+    # A few messages waiting
+    queue_depth(3)
+    polling.sample()
+    parameters = polling.parameters()
+    assert parameters["WaitTimeSeconds"] == 10
+    assert parameters["MaxNumberOfMessages"] == 3
+
+    # Only a few messages but they've been waiting for a while.
+    mocked_message = mocker.MagicMock()
+    mocked_message.attributes = {"SentTimestamp": str(int((1030.0 - 120) * 1000))}
+    polling.observe([mocked_message])
+    assert polling.oldest_age == 120
+    assert polling.parameters()["MaxNumberOfMessages"] == 10
+
+
+def test_delete_messages_in_batches(mocker):
+    mocked_messages = []
+    for i in range(12):
+        mocked_message = mocker.MagicMock()
+        mocked_message.message_id = f"id{i}"
+        mocked_message.receipt_handle = f"handle{i}"
+        mocked_messages.append(mocked_message)
+
+    mocked_queue = mocker.MagicMock()
+    responses = [
+        # The first batch of 10 has one failure that is worth retrying and
+        # one that isn't.
+        {
+            "Successful": [{"Id": str(i)} for i in range(8)],
+            "Failed": [
+                {"Id": "8", "SenderFault": False, "Code": "InternalError"},
+                {"Id": "9", "SenderFault": True, "Code": "ReceiptHandleIsInvalid"},
+            ],
+        },
+        {"Successful": [{"Id": "0"}, {"Id": "1"}]},
+        # The retry
+        {"Successful": [{"Id": "0"}]},
+    ]
+    mocked_queue.delete_messages.side_effect = responses
+    delete_messages(mocked_queue, mocked_messages)
+
+    first, second, third = mocked_queue.delete_messages.call_args_list
+    assert len(first[1]["Entries"]) == 10
+    assert len(second[1]["Entries"]) == 2
+    assert third[1]["Entries"] == [{"Id": "0", "ReceiptHandle": "handle8"}]
 
 
 @mock.patch("buildhub.ingest.sqs.boto3")
@@ -2,12 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
 from unittest import mock
 
 import pytest
 from jsonschema import ValidationError
 
-from buildhub.main.models import Build
+from buildhub.main.models import Build, month_ranges
 from buildhub.main.search import BuildDoc
 from utils import runif_bigquery_testing_enabled
 
@@ -27,6 +28,118 @@ def test_insert(settings, valid_build):
     assert Build.objects.all().count() == 1
 
 
+@pytest.mark.django_db
+def test_insert_many(settings, valid_build, elasticsearch):
+    one = valid_build()
+    two = valid_build()
+    two["download"]["size"] += 1
+    Build.insert(one)
+
+    inserted = Build.insert_many(
+        [
+            {"build": one, "s3_object_key": "one/buildhub.json"},
+            {"build": two, "s3_object_key": "two/buildhub.json"},
+            # Same build twice in the same batch.
+            {"build": two, "s3_object_key": "two/buildhub.json"},
+        ]
+    )
+    (build,) = inserted
+    assert build.build == two
+    assert build.s3_object_key == "two/buildhub.json"
+    assert Build.objects.all().count() == 2
+
+    # Only the inserted one was sent to Elasticsearch
+    elasticsearch.flush()
+    doc = BuildDoc.get(id=build.id)
+    assert doc.download.size == two["download"]["size"]
+
+    assert Build.insert_many([]) == []
+    assert Build.insert_many([{"build": one}, {"build": two}]) == []
+
+
+@pytest.mark.django_db
+def test_insert_many_update_etag(valid_build):
+    one = valid_build()
+    two = valid_build()
+    two["download"]["size"] += 1
+    Build.insert(one, s3_object_key="one/buildhub.json", s3_object_etag="abc123")
+    Build.insert(two, s3_object_key="two/buildhub.json", s3_object_etag="def234")
+
+    three = valid_build()
+    three["download"]["size"] += 2
+    builds = Build.insert_many(
+        [
+            # Same key, new ETag
+            {"build": one, "s3_object_key": "one/buildhub.json", "s3_object_etag": "x"},
+            # Same build under a different key is left alone.
+            {
+                "build": two,
+                "s3_object_key": "other/buildhub.json",
+                "s3_object_etag": "y",
+            },
+            {"build": three, "s3_object_key": "three/buildhub.json"},
+        ],
+        update_etag=True,
+    )
+    assert sorted((build.s3_object_key, build.inserted) for build in builds) == [
+        ("one/buildhub.json", False),
+        ("three/buildhub.json", True),
+    ]
+    assert Build.objects.get(s3_object_key="one/buildhub.json").s3_object_etag == "x"
+    assert (
+        Build.objects.get(s3_object_key="two/buildhub.json").s3_object_etag == "def234"
+    )
+    assert Build.objects.all().count() == 3
+
+
+@pytest.mark.django_db
+def test_indexed_fields(valid_build):
+    build = valid_build()
+    inserted = Build.insert(build)
+    # Set as it's inserted, and returned.
+    assert inserted.build_id == "20180510160705"
+    assert inserted.source_product == "devedition"
+    assert inserted.source_revision == build["source"]["revision"]
+    assert inserted.target_channel == "aurora"
+    assert inserted.target_platform == "macosx"
+    assert inserted.target_version == "61.0b4rc1"
+
+    builds = Build.objects.filter_fields(
+        source__product="devedition", target__channel=["aurora", "beta"]
+    )
+    assert list(builds) == [inserted]
+    # Not an indexed field.
+    assert Build.objects.filter_fields(target__locale="ca").exists()
+    assert not Build.objects.filter_fields(target__locale="en-US").exists()
+
+
+@pytest.mark.django_db
+def test_indexed_fields_copy_many(valid_build):
+    one = valid_build()
+    two = valid_build()
+    two["download"]["size"] += 1
+    del two["target"]["channel"]
+    assert Build.copy_many([{"build": one}, {"build": two}]) == 2
+    assert Build.objects.filter_fields(target__channel="aurora").count() == 1
+    build = Build.objects.get(build_hash=Build.get_build_hash(two))
+    assert build.target_channel is None
+    assert build.build_id == "20180510160705"
+
+
+def test_get_indexed_fields(valid_build):
+    build = valid_build()
+    build["build"]["id"] = 20180510160705
+    del build["target"]["version"]
+    assert Build.get_indexed_fields(build) == [
+        "20180510160705",
+        "devedition",
+        build["source"]["revision"],
+        "aurora",
+        "macosx",
+        None,
+    ]
+
+
 @pytest.mark.django_db
 def test_model_serialization(valid_build):
     """Example document:
@@ -210,6 +323,136 @@ def test_bulk_insert(valid_build):
     assert insert_count == 0
 
 
+@pytest.mark.django_db
+def test_bulk_insert_chunks(valid_build, elasticsearch):
+    one = valid_build()
+    two = valid_build()
+    two["download"]["size"] += 1
+    three = valid_build()
+    three["download"]["size"] += 2
+    Build.insert(one)
+
+    insert_count, skipped = Build.bulk_insert(
+        [one, two, three, two], metadata={"kinto-migration": True}, chunk_size=2
+    )
+    assert (insert_count, skipped) == (2, 0)
+    assert Build.objects.all().count() == 3
+    build = Build.objects.get(build_hash=Build.get_build_hash(three))
+    assert build.metadata["kinto-migration"]
+
+    # The inserted ones are sent to Elasticsearch too.
+    elasticsearch.flush()
+    doc = BuildDoc.get(id=build.id)
+    assert doc.download.size == three["download"]["size"]
+
+
+def test_month_ranges():
+    utc = datetime.timezone.utc
+    first = datetime.datetime(2018, 11, 15, 12, tzinfo=utc)
+    last = datetime.datetime(2019, 1, 1, tzinfo=utc)
+    assert month_ranges(first, last) == [
+        (
+            datetime.datetime(2018, 11, 1, tzinfo=utc),
+            datetime.datetime(2018, 12, 1, tzinfo=utc),
+        ),
+        (
+            datetime.datetime(2018, 12, 1, tzinfo=utc),
+            datetime.datetime(2019, 1, 1, tzinfo=utc),
+        ),
+        (
+            datetime.datetime(2019, 1, 1, tzinfo=utc),
+            datetime.datetime(2019, 2, 1, tzinfo=utc),
+        ),
+    ]
+
+
+@pytest.mark.django_db
+def test_iter_months(valid_build):
+    utc = datetime.timezone.utc
+    created_ats = [
+        datetime.datetime(2019, 3, 2, tzinfo=utc),
+        datetime.datetime(2018, 12, 31, 23, 59, tzinfo=utc),
+        datetime.datetime(2019, 1, 1, tzinfo=utc),
+    ]
+    hashes = []
+    for i, created_at in enumerate(created_ats):
+        build = valid_build()
+        build["download"]["size"] += i
+        inserted = Build.insert(build)
+        Build.objects.filter(id=inserted.id).update(created_at=created_at)
+        hashes.append(inserted.build_hash)
+
+    # Oldest first, even across months that have no builds at all.
+    assert [build.build_hash for build in Build.objects.iter_months()] == [
+        hashes[1],
+        hashes[2],
+        hashes[0],
+    ]
+    builds = Build.objects.created_between(
+        datetime.datetime(2019, 1, 1, tzinfo=utc),
+        datetime.datetime(2019, 3, 1, tzinfo=utc),
+    )
+    assert [build.build_hash for build in builds] == [hashes[2]]
+    assert Build.objects.created_between(until=created_ats[1]).count() == 0
+    assert not list(Build.objects.none().iter_months())
+
+
+@pytest.mark.django_db
+def test_copy_many(valid_build, elasticsearch):
+    one = valid_build()
+    two = valid_build()
+    two["download"]["size"] += 1
+    three = valid_build()
+    three["download"]["size"] += 2
+    Build.insert(one)
+
+    inserted = Build.copy_many(
+        [
+            {"build": one},
+            {"build": two},
+            {"build": two},
+            {"build": three, "s3_object_key": "three/buildhub.json"},
+        ],
+        metadata={"kinto-migration": True},
+        chunk_size=2,
+    )
+    assert inserted == 2
+    assert Build.objects.all().count() == 3
+    build = Build.objects.get(build_hash=Build.get_build_hash(two))
+    assert build.build == two
+    assert build.metadata["kinto-migration"]
+    # Not NULL
+    assert build.s3_object_key == ""
+    build = Build.objects.get(build_hash=Build.get_build_hash(three))
+    assert build.s3_object_key == "three/buildhub.json"
+
+    elasticsearch.flush()
+    doc = BuildDoc.get(id=build.id)
+    assert doc.download.size == three["download"]["size"]
+
+    # Again, and with bulk_insert()
+    assert Build.bulk_insert([one, two, three], copy=True) == (0, 0)
+
+
+@pytest.mark.django_db
+def test_bulk_insert_copy_invalid(valid_build, mocker):
+    one = valid_build()
+    two = valid_build()
+    two.pop("target")
+    Build.insert(one)
+    mocker.spy(Build, "validate_build")
+
+    with pytest.raises(ValidationError):
+        Build.bulk_insert([one, two], copy=True)
+    # Only the one we don't already have is validated.
+    Build.validate_build.assert_called_once_with(two)
+    assert Build.objects.all().count() == 1
+
+    assert Build.bulk_insert([one, two], copy=True, skip_invalid=True) == (0, 1)
+    assert Build.bulk_insert([one, two], copy=True, skip_validation=True) == (1, 0)
+    assert Build.objects.all().count() == 2
+
+
 @pytest.mark.django_db
 def test_bulk_insert_invalid(valid_build):
     one = valid_build()
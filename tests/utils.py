@@ -1,3 +1,4 @@
+import io
 import os
 import uuid
 from google.cloud import bigquery
@@ -16,6 +17,52 @@ def salted_table_id(table_id):
     return f"{table_id}_{salt}"
 
 
+def s3_object_response(data):
+    """Return what `s3_client.get_object()` would return for an S3 object
+    with this content."""
+    return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+
+def s3_list_objects_v2(objs):
+    """Return a function that behaves like `s3_client.list_objects_v2()` on a
+    bucket with these objects (dicts with at least "Key" and "ETag")."""
+    objs = sorted(objs, key=lambda obj: obj["Key"])
+
+    def list_objects_v2(
+        Bucket,
+        Prefix="",
+        Delimiter=None,
+        MaxKeys=1000,
+        StartAfter="",
+        ContinuationToken=None,
+    ):
+        contents = []
+        common_prefixes = []
+        after = ContinuationToken or StartAfter
+        start = len(Prefix)
+        for obj in objs:
+            key = obj["Key"]
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            if Delimiter and Delimiter in key[start:]:
+                end = key.index(Delimiter, start) + 1
+                common_prefix = key[:end]
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+            else:
+                contents.append(obj)
+        resp = {}
+        if contents:
+            resp["Contents"] = contents[:MaxKeys]
+        if common_prefixes:
+            resp["CommonPrefixes"] = [{"Prefix": p} for p in common_prefixes]
+        if len(contents) > MaxKeys:
+            resp["NextContinuationToken"] = contents[MaxKeys - 1]["Key"]
+        return resp
+
+    return list_objects_v2
+
+
 def runif_bigquery_testing_enabled(func):
     """A decorator that will skip the test if the current environment is not
     set up for running tests.